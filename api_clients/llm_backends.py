@@ -0,0 +1,401 @@
+import asyncio
+import aiohttp
+import json
+import logging
+import time
+from metrics import (
+    LLM_QUEUE_WAIT_SECONDS,
+    LLM_REQUEST_SECONDS,
+    LLM_TOKENS,
+    LLM_WARM_UP_SECONDS,
+)
+from config import (
+    LLM_BACKEND,
+    OLLAMA_API_URL,
+    OPENAI_API_URL,
+    OPENAI_API_KEY,
+    OLLAMA_MAX_GENERATIONS,
+    LLM_HEALTH_CHECK_INTERVAL,
+    OLLAMA_WARM_UP_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = "You are a helpful AI assistant that summarizes newsletter content."
+HEALTH_CHECK_TIMEOUT = aiohttp.ClientTimeout(total=5)
+# The pool's session has no total timeout (generations can be long); a
+# warm-up must not hang on a host that accepts connections and stalls
+WARM_UP_TIMEOUT = aiohttp.ClientTimeout(total=OLLAMA_WARM_UP_TIMEOUT, sock_connect=10)
+
+# Errors that mean the host itself is unreachable, not that one request failed
+CONNECTION_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+# A generation whose model load took longer than this paid a cold start
+COLD_LOAD_SECONDS = 1.0
+
+
+class LLMBackend:
+    # One inference host. Subclasses implement generate() and health_path.
+    # `capacity` caps concurrent generations on this host; `outstanding`
+    # counts the generations currently running on it.
+
+    health_path = None
+
+    def __init__(self, base_url, max_generations=OLLAMA_MAX_GENERATIONS):
+        self.base_url = base_url.rstrip("/")
+        self.capacity = max(1, max_generations)
+        self.outstanding = 0
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.cold_generations = 0
+        self.load_seconds = 0.0
+        # {"cold"/"warm": [count, total seconds]} for warm-up calls
+        self.warmups = {"cold": [0, 0.0], "warm": [0, 0.0]}
+
+    def headers(self):
+        return {}
+
+    async def check_health(self, session):
+        try:
+            async with session.get(
+                f"{self.base_url}{self.health_path}",
+                headers=self.headers(),
+                timeout=HEALTH_CHECK_TIMEOUT,
+            ) as response:
+                healthy = response.status == 200
+        except CONNECTION_ERRORS:
+            healthy = False
+        if healthy != self.healthy:
+            logger.warning(
+                "LLM backend %s is now %s", self.base_url, "up" if healthy else "down"
+            )
+        self.healthy = healthy
+        return healthy
+
+    async def generate(
+        self, session, prompt, model, on_progress=None, options=None, keep_alive=None
+    ):
+        raise NotImplementedError
+
+    async def warm_up(self, session, model, keep_alive=None):
+        # Returns (seconds, was_cold), or None if the backend can't preload
+        return None
+
+    def record_tokens(self, prompt_tokens, completion_tokens):
+        if prompt_tokens is not None:
+            LLM_TOKENS.observe(prompt_tokens, backend=self.base_url, kind="prompt")
+        if completion_tokens is not None:
+            LLM_TOKENS.observe(
+                completion_tokens, backend=self.base_url, kind="completion"
+            )
+
+    def record_warm_up(self, seconds, cold):
+        kind = "cold" if cold else "warm"
+        entry = self.warmups[kind]
+        entry[0] += 1
+        entry[1] += seconds
+        LLM_WARM_UP_SECONDS.observe(seconds, backend=self.base_url, kind=kind)
+
+    def stats(self):
+        stats = {
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "cold_generations": self.cold_generations,
+            "load_seconds": round(self.load_seconds, 2),
+        }
+        for kind, (count, total) in self.warmups.items():
+            stats[f"{kind}_warmups"] = count
+            stats[f"{kind}_warmup_avg_seconds"] = (
+                round(total / count, 3) if count else 0.0
+            )
+        return stats
+
+
+class OllamaBackend(LLMBackend):
+    health_path = "/api/tags"
+
+    async def generate(
+        self, session, prompt, model, on_progress=None, options=None, keep_alive=None
+    ):
+        stream = on_progress is not None
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "system": SYSTEM_PROMPT,
+            "stream": stream,
+        }
+        if options:
+            payload["options"] = options
+        if keep_alive:
+            payload["keep_alive"] = keep_alive
+        async with session.post(
+            f"{self.base_url}/api/generate", json=payload
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"API call failed with status {response.status}")
+            if not stream:
+                data = await response.json()
+                self._record_stats(data)
+                return data.get("response", "")
+            # Ollama streams one JSON object per line, each carrying the next
+            # piece of the response, until an object with "done": true.
+            text = ""
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise Exception(f"API stream failed: {data['error']}")
+                piece = data.get("response", "")
+                if piece:
+                    text += piece
+                    await on_progress(text)
+                if data.get("done"):
+                    self._record_stats(data)
+                    break
+            return text
+
+    def _record_stats(self, data):
+        # Ollama reports token counts and how long loading the model took (in
+        # ns) with the final response; a long load means the model had been
+        # unloaded.
+        self.record_tokens(data.get("prompt_eval_count"), data.get("eval_count"))
+        load_seconds = data.get("load_duration", 0) / 1e9
+        self.load_seconds += load_seconds
+        if load_seconds >= COLD_LOAD_SECONDS:
+            self.cold_generations += 1
+
+    async def warm_up(self, session, model, keep_alive=None):
+        # /api/ps lists the models currently in memory; a generate request
+        # without a prompt just loads the model and resets its keep_alive.
+        async with session.get(
+            f"{self.base_url}/api/ps", timeout=HEALTH_CHECK_TIMEOUT
+        ) as response:
+            running = (await response.json()).get("models", []) if response.ok else []
+        cold = not any(
+            m.get("name") == model or m.get("model") == model for m in running
+        )
+        payload = {"model": model}
+        if keep_alive:
+            payload["keep_alive"] = keep_alive
+        started = time.monotonic()
+        async with session.post(
+            f"{self.base_url}/api/generate", json=payload, timeout=WARM_UP_TIMEOUT
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"Warm-up failed with status {response.status}")
+            await response.read()
+        seconds = time.monotonic() - started
+        self.record_warm_up(seconds, cold)
+        return seconds, cold
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    # Any server speaking the OpenAI chat completions API (llama.cpp server,
+    # vLLM, LM Studio, ...). `base_url` includes the /v1 prefix.
+    health_path = "/models"
+
+    def __init__(self, base_url, api_key=OPENAI_API_KEY, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.api_key = api_key
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    async def generate(
+        self, session, prompt, model, on_progress=None, options=None, keep_alive=None
+    ):
+        # Only the options with an OpenAI equivalent are passed on
+        stream = on_progress is not None
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            "stream": stream,
+        }
+        if stream:
+            # Ask for a final chunk carrying the token usage
+            payload["stream_options"] = {"include_usage": True}
+        options = options or {}
+        if "temperature" in options:
+            payload["temperature"] = options["temperature"]
+        if "num_predict" in options:
+            payload["max_tokens"] = options["num_predict"]
+        async with session.post(
+            f"{self.base_url}/chat/completions",
+            headers=self.headers(),
+            json=payload,
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"API call failed with status {response.status}")
+            if not stream:
+                data = await response.json()
+                self._record_usage(data.get("usage"))
+                return data["choices"][0]["message"].get("content") or ""
+            # Server-sent events: "data: {json}" lines, ending with "data: [DONE]"
+            text = ""
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[len(b"data:") :].strip()
+                if payload == b"[DONE]":
+                    break
+                data = json.loads(payload)
+                self._record_usage(data.get("usage"))
+                choices = data.get("choices") or [{}]
+                piece = choices[0].get("delta", {}).get("content")
+                if piece:
+                    text += piece
+                    await on_progress(text)
+            return text
+
+    def _record_usage(self, usage):
+        if usage:
+            self.record_tokens(
+                usage.get("prompt_tokens"), usage.get("completion_tokens")
+            )
+
+
+class BackendPool:
+    # Spreads generations over several hosts: each request waits until some
+    # healthy backend has a free slot and then goes to the one with the fewest
+    # outstanding requests, so faster hosts naturally take more of the work.
+    # A host that refuses connections is marked down until the periodic
+    # health check sees it answer again.
+
+    def __init__(self, backends, health_check_interval=LLM_HEALTH_CHECK_INTERVAL):
+        if not backends:
+            raise ValueError("BackendPool needs at least one backend")
+        self.backends = backends
+        self.health_check_interval = health_check_interval
+        self._session = None
+        self._health_task = None
+        self._available = asyncio.Condition()
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            # No total timeout: long generations are normal on small hosts
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10)
+            )
+        if self._health_task is None and self.health_check_interval > 0:
+            self._health_task = asyncio.create_task(self._health_loop())
+        return self._session
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            return await self.start()
+        return self._session
+
+    async def check_health(self):
+        session = await self._get_session()
+        await asyncio.gather(
+            *(backend.check_health(session) for backend in self.backends)
+        )
+        async with self._available:
+            self._available.notify_all()
+
+    async def _health_loop(self):
+        while True:
+            try:
+                await self.check_health()
+            except Exception as e:
+                logger.error("LLM health check failed: %s", e)
+            await asyncio.sleep(self.health_check_interval)
+
+    def pick(self):
+        # Least outstanding healthy backend with a free slot, or None. If every
+        # host looks down, still try them rather than failing outright.
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        free = [b for b in candidates if b.outstanding < b.capacity]
+        if not free:
+            return None
+        return min(free, key=lambda backend: backend.outstanding / backend.capacity)
+
+    async def generate(
+        self, prompt, model, on_progress=None, options=None, keep_alive=None
+    ):
+        session = await self._get_session()
+        waiting_since = time.monotonic()
+        async with self._available:
+            await self._available.wait_for(lambda: self.pick() is not None)
+            backend = self.pick()
+            backend.outstanding += 1
+        started = time.monotonic()
+        LLM_QUEUE_WAIT_SECONDS.observe(started - waiting_since)
+        backend.requests += 1
+        outcome = "error"
+        try:
+            text = await backend.generate(
+                session, prompt, model, on_progress, options, keep_alive
+            )
+            outcome = "ok"
+            return text
+        except CONNECTION_ERRORS:
+            outcome = "unreachable"
+            backend.failures += 1
+            backend.healthy = False
+            logger.warning("LLM backend %s unreachable, marked down", backend.base_url)
+            raise
+        except Exception:
+            backend.failures += 1
+            raise
+        finally:
+            LLM_REQUEST_SECONDS.observe(
+                time.monotonic() - started,
+                backend=backend.base_url,
+                model=model,
+                outcome=outcome,
+            )
+            backend.outstanding -= 1
+            async with self._available:
+                self._available.notify()
+
+    async def warm_up(self, model, keep_alive=None):
+        # Preloads `model` on every healthy host at once. Returns
+        # {base_url: (seconds, was_cold)} for the hosts that support it.
+        session = await self._get_session()
+        backends = [b for b in self.backends if b.healthy]
+        results = await asyncio.gather(
+            *(b.warm_up(session, model, keep_alive) for b in backends),
+            return_exceptions=True,
+        )
+        warmed = {}
+        for backend, result in zip(backends, results):
+            if isinstance(result, Exception):
+                logger.warning(
+                    "Warm-up of %s on %s failed: %r", model, backend.base_url, result
+                )
+            elif result is not None:
+                warmed[backend.base_url] = result
+        return warmed
+
+    def stats(self):
+        return {backend.base_url: backend.stats() for backend in self.backends}
+
+
+BACKENDS = {
+    "ollama": (OllamaBackend, OLLAMA_API_URL),
+    "openai": (OpenAICompatibleBackend, OPENAI_API_URL),
+}
+
+
+def build_backend_pool(kind=LLM_BACKEND):
+    backend_class, urls = BACKENDS[kind]
+    return BackendPool(
+        [backend_class(url.strip()) for url in urls.split(",") if url.strip()]
+    )
@@ -1,107 +1,333 @@
-# api_clients/mail_tm.py
+import asyncio
 import aiohttp
-from config import MAIL_TM_API_URL
+import time
+from datetime import datetime, timezone
+from config import (
+    MAIL_TM_API_URL,
+    MAIL_TM_CONN_LIMIT,
+    MAIL_TM_CONN_LIMIT_PER_HOST,
+    MAIL_TM_DNS_CACHE_TTL,
+    MAIL_TM_KEEPALIVE_TIMEOUT,
+    MAIL_TM_MESSAGE_CONCURRENCY,
+    MAIL_TM_MAILBOX_CONCURRENCY,
+)
 import logging
+from metrics import MAIL_TM_REQUEST_SECONDS, Gauge
+from logging_setup import SAMPLED
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+
+
+class MailTMUnauthorized(Exception):
+    """Raised when mail.tm rejects a bearer token (HTTP 401)."""
+
+
+def parse_timestamp(value):
+    # mail.tm returns ISO 8601 timestamps with an offset; the database stores
+    # naive UTC datetimes, so normalize to that for comparisons.
+    if not value:
+        return datetime.min
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _endpoint(url):
+    # /messages/<id> -> /messages/{id}, so ids never become label values
+    segments = [segment for segment in url.path.split("/") if segment]
+    if not segments:
+        return "/"
+    return f"/{segments[0]}" + ("/{id}" if len(segments) > 1 else "")
+
+
+async def _on_request_start(session, context, params):
+    context.started = time.monotonic()
+
+
+async def _on_request_end(session, context, params):
+    MAIL_TM_REQUEST_SECONDS.observe(
+        time.monotonic() - context.started,
+        method=params.method,
+        endpoint=_endpoint(params.url),
+        status=params.response.status,
+    )
+
+
+async def _on_request_exception(session, context, params):
+    MAIL_TM_REQUEST_SECONDS.observe(
+        time.monotonic() - context.started,
+        method=params.method,
+        endpoint=_endpoint(params.url),
+        status="error",
+    )
+
+
+def _trace_config():
+    # Times every request made through the session, by endpoint and status
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
+    return trace_config
 
 
 class MailTMClient:
-    def __init__(self):
+    def __init__(
+        self,
+        limit=MAIL_TM_CONN_LIMIT,
+        limit_per_host=MAIL_TM_CONN_LIMIT_PER_HOST,
+        dns_cache_ttl=MAIL_TM_DNS_CACHE_TTL,
+        keepalive_timeout=MAIL_TM_KEEPALIVE_TIMEOUT,
+        message_concurrency=MAIL_TM_MESSAGE_CONCURRENCY,
+    ):
         self.base_url = MAIL_TM_API_URL
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.message_concurrency = message_concurrency
+        # Caps how many mailboxes are being fetched at once across all workers
+        self.mailbox_slots = asyncio.Semaphore(MAIL_TM_MAILBOX_CONCURRENCY)
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[_trace_config()]
+            )
+            logger.info(
+                "MailTMClient session opened (limit=%s, limit_per_host=%s)",
+                self.limit,
+                self.limit_per_host,
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("MailTMClient session closed")
+        self._session = None
+
+    async def _get_session(self):
+        # Lazily open the pool so the client also works outside the Application
+        # lifecycle (scripts, one-off jobs).
+        if self._session is None or self._session.closed:
+            return await self.start()
+        return self._session
+
+    def pool_stats(self):
+        connector = self._session.connector if self._session else None
+        if connector is None or connector.closed:
+            return {"open": 0, "idle": 0, "in_flight": 0}
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        in_flight = len(getattr(connector, "_acquired", ()))
+        return {"open": idle + in_flight, "idle": idle, "in_flight": in_flight}
 
     async def get_domains(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{self.base_url}/domains") as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data["hydra:member"]
-                else:
-                    return None
+        session = await self._get_session()
+        async with session.get(f"{self.base_url}/domains") as response:
+            if response.status == 200:
+                data = await response.json()
+                return data["hydra:member"]
+            else:
+                return None
 
     async def create_account(self, address, password):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/accounts",
-                json={"address": address, "password": password},
-            ) as response:
-                if response.status == 201:
-                    data = await response.json()
-                    return data
-                else:
-                    return None
+        session = await self._get_session()
+        async with session.post(
+            f"{self.base_url}/accounts",
+            json={"address": address, "password": password},
+        ) as response:
+            if response.status == 201:
+                data = await response.json()
+                return data
+            else:
+                return None
 
     async def get_token(self, address, password):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/token",
-                json={"address": address, "password": password},
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data["token"]
-                else:
-                    return None
+        session = await self._get_session()
+        async with session.post(
+            f"{self.base_url}/token",
+            json={"address": address, "password": password},
+        ) as response:
+            if response.status == 200:
+                data = await response.json()
+                return data["token"]
+            else:
+                return None
 
-    async def fetch_unread_messages(self, token):
+    async def iter_unread_messages(self, token, since=None, failures=None):
+        # Walks /messages page by page (newest first) and yields the full body
+        # of every unread message as soon as its page has been fetched. Stops
+        # at the last page, or at the first message created at or before
+        # `since` (a naive UTC datetime) since those were already processed.
+        # Messages that couldn't be fetched are appended to `failures` as
+        # (message id, createdAt, error); a page that couldn't be listed as
+        # (None, None, error), since anything older than it went unseen.
         headers = {"Authorization": f"Bearer {token}"}
-        async with aiohttp.ClientSession(headers=headers) as session:
+        session = await self._get_session()
+        page = 1
+        listed = 0
+        while True:
             async with session.get(
-                f"{self.base_url}/messages?page=1&isDeleted=false"
+                f"{self.base_url}/messages",
+                params={"page": page, "isDeleted": "false"},
+                headers=headers,
             ) as response:
-                if response.status == 200:
-                    print("Fetching messages...")
-                    print(f"message response: {response}")
-                    data = await response.json()
-                    all_messages = data["hydra:member"]
-                    print(f"Received messages data: {data}")
-
-                    # Filter unread messages
-                    unread_messages = [
-                        msg for msg in all_messages if msg.get("seen") == False
-                    ]
-                    print(f"Number of unread messages: {len(unread_messages)}")
-
-                    full_messages = []
-                    for message in unread_messages:
-                        # Fetch full message content
-                        async with session.get(
-                            f"{self.base_url}/messages/{message['id']}"
-                        ) as msg_response:
-                            if msg_response.status == 200:
-                                full_message = await msg_response.json()
-                                print(f"Full unread message data: {full_message}")
-                                full_messages.append(full_message)
-                            else:
-                                logger.error(
-                                    f"Failed to fetch full unread message: {message['id']}"
-                                )
-                    return full_messages
-                else:
-                    logger.error(f"Failed to fetch messages. Status: {response.status}")
-                    return []
+                if response.status == 401:
+                    raise MailTMUnauthorized(f"messages page {page}")
+                if response.status != 200:
+                    logger.error(
+                        "Failed to fetch messages page %s. Status: %s",
+                        page,
+                        response.status,
+                    )
+                    if failures is not None:
+                        failures.append(
+                            (None, None, Exception(f"status {response.status}"))
+                        )
+                    return
+                data = await response.json()
+
+            members = data.get("hydra:member", [])
+            listed += len(members)
+            reached_cursor = False
+            unread = {}
+            for message in members:
+                if (
+                    since is not None
+                    and parse_timestamp(message.get("createdAt")) <= since
+                ):
+                    reached_cursor = True
+                    break
+                if message.get("seen") == False:
+                    unread[message["id"]] = parse_timestamp(message.get("createdAt"))
+            logger.debug(
+                "Page %s: %s unread of %s messages", page, len(unread), len(members)
+            )
+
+            full_messages, fetch_failures = await self.fetch_messages(
+                token, list(unread)
+            )
+            for message_id, error in fetch_failures:
+                if isinstance(error, MailTMUnauthorized):
+                    raise error
+                logger.error(
+                    "Failed to fetch full unread message: %s (%s)", message_id, error
+                )
+                if failures is not None:
+                    failures.append((message_id, unread[message_id], error))
+            for full_message in full_messages:
+                yield full_message
+
+            if reached_cursor or not members:
+                return
+            view = data.get("hydra:view", {})
+            total = data.get("hydra:totalItems")
+            if "hydra:next" not in view and (total is None or listed >= total):
+                return
+            page += 1
+
+    async def fetch_unread_messages(self, token, since=None):
+        return [message async for message in self.iter_unread_messages(token, since)]
+
+    async def _gather_bounded(self, items, func, concurrency=None):
+        # Runs func(item) for every item with at most `concurrency` in flight.
+        # Results keep the order of `items`; exceptions are returned in place
+        # so one failing message doesn't abort the batch.
+        semaphore = asyncio.Semaphore(max(1, concurrency or self.message_concurrency))
+
+        async def run(item):
+            async with semaphore:
+                return await func(item)
+
+        return await asyncio.gather(
+            *(run(item) for item in items), return_exceptions=True
+        )
+
+    async def fetch_message(self, token, message_id):
+        headers = {"Authorization": f"Bearer {token}"}
+        session = await self._get_session()
+        async with session.get(
+            f"{self.base_url}/messages/{message_id}", headers=headers
+        ) as response:
+            if response.status == 200:
+                full_message = await response.json()
+                logger.debug("Fetched message %s", message_id, extra=SAMPLED)
+                return full_message
+            elif response.status == 401:
+                raise MailTMUnauthorized(f"message {message_id}")
+            else:
+                raise Exception(f"status {response.status}")
+
+    async def fetch_messages(self, token, message_ids, concurrency=None):
+        results = await self._gather_bounded(
+            message_ids, lambda mid: self.fetch_message(token, mid), concurrency
+        )
+        messages, failures = [], []
+        for message_id, result in zip(message_ids, results):
+            if isinstance(result, Exception):
+                failures.append((message_id, result))
+            else:
+                messages.append(result)
+        return messages, failures
 
     async def mark_message_as_read(self, token, message_id):
         headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/merge-patch+json",  # This is the key change
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.patch(
-                f"{self.base_url}/messages/{message_id}",
-                headers=headers,
-                json={"seen": True},
-            ) as response:
-                if response.status == 200:
-                    logger.info(f"Marked message {message_id} as read")
-                    return True
-                else:
-                    response_text = await response.text()
-                    logger.error(
-                        f"Failed to mark message {message_id} as read. Status: {response.status}, Response: {response_text}"
-                    )
-                    return False
+        session = await self._get_session()
+        async with session.patch(
+            f"{self.base_url}/messages/{message_id}",
+            headers=headers,
+            json={"seen": True},
+        ) as response:
+            if response.status == 200:
+                logger.debug("Marked message %s as read", message_id, extra=SAMPLED)
+                return True
+            elif response.status == 401:
+                raise MailTMUnauthorized(f"message {message_id}")
+            else:
+                response_text = await response.text()
+                logger.error(
+                    "Failed to mark message %s as read. Status: %s, Response: %s",
+                    message_id,
+                    response.status,
+                    response_text,
+                )
+                return False
+
+    async def mark_messages_as_read(self, token, message_ids, concurrency=None):
+        results = await self._gather_bounded(
+            message_ids, lambda mid: self.mark_message_as_read(token, mid), concurrency
+        )
+        failures = []
+        for message_id, result in zip(message_ids, results):
+            if isinstance(result, Exception):
+                logger.error("Error marking message %s as read: %s", message_id, result)
+                failures.append((message_id, result))
+            elif not result:
+                failures.append((message_id, None))
+        return failures
 
 
 mail_tm_client = MailTMClient()
+
+Gauge(
+    "mail_tm_connections",
+    "Open connections in the mail.tm connection pool.",
+    ("state",),
+    callback=lambda: {
+        ("idle",): mail_tm_client.pool_stats()["idle"],
+        ("in_flight",): mail_tm_client.pool_stats()["in_flight"],
+    },
+)
@@ -1,62 +1,33 @@
 # api_clients/ollama.py
-import aiohttp
+import asyncio
 import logging
+import re
+import time
 from tenacity import retry, stop_after_attempt, wait_exponential
-from config import OLLAMA_API_URL
-
+from api_clients.llm_backends import build_backend_pool
+from cpu_pool import cpu_pool
+from metrics import SUMMARY_CHUNKS, SUMMARY_CACHE_LOOKUPS, Counter
+from logging_setup import SAMPLED
+from config import (
+    LLM_MODEL,
+    LLM_MODELS,
+    OLLAMA_CONCURRENCY,
+    OLLAMA_REDUCE_FAN_IN,
+    OLLAMA_CHUNK_TOKENS,
+    OLLAMA_CHUNK_OVERLAP_TOKENS,
+    OLLAMA_STREAM,
+    OLLAMA_NUM_CTX,
+    OLLAMA_NUM_PREDICT,
+    OLLAMA_TEMPERATURE,
+    OLLAMA_KEEP_ALIVE,
+)
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
 
-def chunk_text(text, max_chunk_size=8000):
-    chunks = []
-    current_chunk = ""
-    for sentence in text.split("."):
-        if len(current_chunk) + len(sentence) < max_chunk_size:
-            current_chunk += sentence + "."
-        else:
-            chunks.append(current_chunk.strip())
-            current_chunk = sentence + "."
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    return chunks
+SUMMARY_PROMPT = """Summarize this newsletter chunk comprehensively:
 
-
-class OllamaClient:
-    def __init__(self, base_url):
-        self.base_url = base_url
-        self.max_chunk_size = 8000
-
-    async def summarize_text(self, text):
-        return await self._recursive_summarize([text])
-
-    async def _recursive_summarize(self, chunks):
-        print(f"Chunks to summarize: {len(chunks)}")
-        if len(chunks) == 1 and len(chunks[0]) <= self.max_chunk_size:
-            return await self._generate_final_summary(chunks[0])
-
-        summaries = []
-        for chunk in chunks:
-            summary = await self._generate_summary(chunk)
-            summaries.append(summary)
-            print(
-                f"Summary generated: {summary[:100]}..."
-            )  # Print first 100 chars of each summary
-
-        combined_summary = " ".join(summaries)
-        if len(combined_summary) <= self.max_chunk_size:
-            return await self._generate_final_summary(combined_summary)
-        else:
-            return await self._recursive_summarize(chunk_text(combined_summary))
-
-    @retry(
-        stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
-    )
-    async def _generate_summary(self, chunk):
-        prompt = f"""Summarize this newsletter chunk comprehensively:
-
-            {chunk}
+            {text}
 
             Include:
             - All main topics/headlines
@@ -70,13 +41,7 @@ class OllamaClient:
             - No length limit, focus on completeness
         """
 
-        return await self._make_api_call(prompt)
-
-    @retry(
-        stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
-    )
-    async def _generate_final_summary(self, text):
-        prompt = f"""Create detailed Telegram newsletter summary:
+FINAL_SUMMARY_PROMPT = """Create detailed Telegram newsletter summary:
 
             {text}
 
@@ -89,25 +54,351 @@ class OllamaClient:
 
         """
 
-        return await self._make_api_call(prompt)
-
-    async def _make_api_call(self, prompt):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/api/generate",
-                json={
-                    "model": "gemma2:2b",
-                    "prompt": prompt,
-                    "system": "You are a helpful AI assistant that summarizes newsletter content.",
-                    "stream": False,
-                },
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get("response", "")
-                else:
-                    raise Exception(f"API call failed with status {response.status}")
-
-
-ollama_client = OllamaClient(OLLAMA_API_URL)
+
+CHARS_PER_TOKEN = 4
+
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+# A sentence ends at . ! or ? followed by whitespace, so dots inside URLs,
+# decimals and e-mail addresses never split.
+SENTENCE_END_RE = re.compile(r"[.!?]+[\"')\]]*\s+")
+ABBREVIATIONS = {
+    "e.g", "i.e", "etc", "vs", "mr", "mrs", "ms", "dr", "prof", "inc", "ltd",
+    "jr", "sr", "st", "no", "fig", "approx", "jan", "feb", "mar", "apr", "jun",
+    "jul", "aug", "sep", "sept", "oct", "nov", "dec", "u.s", "u.k",
+}  # fmt: skip
+
+
+def estimate_tokens(text):
+    # Rough token count for English text; good enough to stay inside the
+    # model's context window without pulling in a tokenizer.
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def _split_sentences(paragraph):
+    sentences = []
+    start = 0
+    for match in SENTENCE_END_RE.finditer(paragraph):
+        word_start = max(
+            start - 1,
+            paragraph.rfind(" ", start, match.start()),
+            paragraph.rfind("\n", start, match.start()),
+        )
+        word = paragraph[word_start + 1 : match.start()]
+        if word.lower().lstrip("(\"'") in ABBREVIATIONS:
+            continue
+        sentences.append(paragraph[start : match.end()].strip())
+        start = match.end()
+    if start < len(paragraph):
+        sentences.append(paragraph[start:].strip())
+    return [sentence for sentence in sentences if sentence]
+
+
+def _split_oversized(text, max_tokens):
+    # Last resort for a single sentence over budget: split on whitespace, and
+    # hard-slice any single "word" (e.g. a huge URL) that is still too long.
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    pieces = []
+    current = []
+    current_len = 0
+    for word in text.split():
+        if len(word) > max_chars:
+            # Write out the words before it first so the order is kept
+            if current:
+                pieces.append(" ".join(current))
+                current, current_len = [], 0
+            while len(word) > max_chars:
+                pieces.append(word[:max_chars])
+                word = word[max_chars:]
+        if current and current_len + 1 + len(word) > max_chars:
+            pieces.append(" ".join(current))
+            current, current_len = [], 0
+        current.append(word)
+        current_len += len(word) + (1 if current_len else 0)
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def _units(text, max_tokens):
+    # Yields (separator, unit) pairs: whole paragraphs when they fit the
+    # budget, otherwise their sentences, otherwise word-split pieces.
+    for paragraph in PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            yield "\n\n", paragraph
+            continue
+        separator = "\n\n"
+        for sentence in _split_sentences(paragraph):
+            if estimate_tokens(sentence) <= max_tokens:
+                yield separator, sentence
+            else:
+                for piece in _split_oversized(sentence, max_tokens):
+                    yield separator, piece
+                    separator = " "
+            separator = " "
+
+
+def chunk_text(text, max_tokens=2000, overlap_tokens=0):
+    # Packs paragraphs/sentences greedily into chunks of at most `max_tokens`
+    # estimated tokens. Each unit is visited once and chunks are joined once,
+    # so this is linear in the input size. With `overlap_tokens`, trailing
+    # units of a chunk are repeated at the start of the next one.
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    overlap_chars = min(overlap_tokens, max_tokens // 2) * CHARS_PER_TOKEN
+    chunks = []
+    parts = []
+    size = 0
+    for separator, unit in _units(text, max_tokens):
+        added = len(unit) + (len(separator) if parts else 0)
+        if parts and size + added > max_chars:
+            chunks.append("".join(parts))
+            carried = []
+            carried_size = 0
+            if overlap_chars:
+                for i in range(len(parts) - 1, -1, -2):
+                    piece = parts[i]
+                    if carried_size + len(piece) + 1 > overlap_chars:
+                        break
+                    carried.insert(0, piece)
+                    carried_size += len(piece) + 1
+                if carried_size + len(separator) + len(unit) > max_chars:
+                    carried, carried_size = [], 0
+            parts = []
+            size = 0
+            for piece in carried:
+                if parts:
+                    parts.append(" ")
+                    size += 1
+                parts.append(piece)
+                size += len(piece)
+            added = len(unit) + (len(separator) if parts else 0)
+        if parts:
+            parts.append(separator)
+        parts.append(unit)
+        size += added
+    if parts:
+        chunks.append("".join(parts))
+    return chunks
+
+
+class OllamaClient:
+    def __init__(
+        self, backend, concurrency=OLLAMA_CONCURRENCY, fan_in=OLLAMA_REDUCE_FAN_IN
+    ):
+        # `backend` is a BackendPool (api_clients/llm_backends.py); it picks
+        # the host and caps concurrent generations per host.
+        self.backend = backend
+        self.model = LLM_MODEL
+        self.models = LLM_MODELS
+        self.max_chunk_tokens = OLLAMA_CHUNK_TOKENS
+        self.chunk_overlap_tokens = OLLAMA_CHUNK_OVERLAP_TOKENS
+        # Optional summary cache (database/summary_cache.py), set up in main.py
+        self.cache = None
+        self._warm_up_task = None
+        # Bounds the generations of one digest; the per-host caps bound all
+        # digests together.
+        self.concurrency = concurrency
+        self.fan_in = max(2, fan_in)
+        self.stream = OLLAMA_STREAM
+        # Sent with every generation; unset values keep the model defaults
+        options = {
+            "num_ctx": OLLAMA_NUM_CTX,
+            "num_predict": OLLAMA_NUM_PREDICT,
+            "temperature": OLLAMA_TEMPERATURE,
+        }
+        self.options = {k: v for k, v in options.items() if v is not None}
+        self.keep_alive = OLLAMA_KEEP_ALIVE
+
+    def model_for(self, model):
+        # A mailbox's stored model, or the default if it's unset or no longer
+        # in LLM_MODELS
+        return model if model in self.models else self.model
+
+    async def start(self):
+        await self.backend.start()
+
+    async def close(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            await asyncio.gather(self._warm_up_task, return_exceptions=True)
+            self._warm_up_task = None
+        await self.backend.close()
+
+    def start_warm_up(self):
+        # Startup warm-up in the background so a slow model load (or a hung
+        # host) doesn't hold up receiving updates. Health first so only
+        # reachable hosts are loaded.
+        async def run():
+            try:
+                await self.backend.check_health()
+            except Exception as e:
+                logger.warning("Health check before warm-up failed: %s", e)
+            await self.warm_up()
+
+        if self._warm_up_task is None or self._warm_up_task.done():
+            self._warm_up_task = asyncio.create_task(run())
+
+    async def warm_up(self, models=None):
+        # Loads the models ahead of the first real request so a digest after
+        # an idle period doesn't pay the model load. Never raises.
+        for model in models or {self.model}:
+            try:
+                warmed = await self.backend.warm_up(model, self.keep_alive)
+            except Exception as e:
+                logger.warning("Warm-up of %s failed: %s", model, e)
+                continue
+            for url, (seconds, cold) in warmed.items():
+                logger.info(
+                    "Warm-up of %s on %s: %.2fs (%s)",
+                    model,
+                    url,
+                    seconds,
+                    "cold load" if cold else "already loaded",
+                )
+
+    async def summarize_text(self, text, on_progress=None, model=None):
+        # `on_progress(partial_text)` is awaited while the final summary is
+        # being generated, so callers can show it before it's complete.
+        # `model` overrides the default model for this digest.
+        return await self._recursive_summarize([text], on_progress, model or self.model)
+
+    async def summarize_document(self, text, model=None):
+        # Standalone summary of one document (e.g. one email) using only the
+        # chunk prompt, meant to be combined with others by summarize_text.
+        model = model or self.model
+        chunks = await cpu_pool.run(
+            chunk_text,
+            text,
+            self.max_chunk_tokens,
+            self.chunk_overlap_tokens,
+            size=len(text),
+        )
+        SUMMARY_CHUNKS.observe(len(chunks or [text]), kind="email")
+        summaries = await self._summarize_all(chunks or [text], model)
+        while len(summaries) > 1:
+            summaries = await self._summarize_all(
+                self._group_summaries(summaries), model
+            )
+        return summaries[0]
+
+    async def _recursive_summarize(self, chunks, on_progress, model):
+        logger.debug("Chunks to summarize: %s", len(chunks))
+        if len(chunks) == 1 and estimate_tokens(chunks[0]) <= self.max_chunk_tokens:
+            SUMMARY_CHUNKS.observe(1, kind="digest")
+            return await self._generate_final_summary(chunks[0], on_progress, model)
+
+        # Map: summarize every chunk concurrently
+        pieces = []
+        for chunk in chunks:
+            if estimate_tokens(chunk) > self.max_chunk_tokens:
+                pieces.extend(
+                    await cpu_pool.run(
+                        chunk_text,
+                        chunk,
+                        self.max_chunk_tokens,
+                        self.chunk_overlap_tokens,
+                        size=len(chunk),
+                    )
+                )
+            else:
+                pieces.append(chunk)
+        chunks = pieces
+        SUMMARY_CHUNKS.observe(len(chunks), kind="digest")
+        summaries = await self._summarize_all(chunks, model)
+
+        # Reduce: merge summaries in groups of at most `fan_in` until they fit
+        # into a single final prompt. Each level shrinks the list by at least
+        # half, so depth is O(log n) and no level re-chunks the whole text.
+        while (
+            len(summaries) > 1
+            and estimate_tokens(" ".join(summaries)) > self.max_chunk_tokens
+        ):
+            groups = self._group_summaries(summaries)
+            logger.debug(
+                "Reducing %s summaries in %s groups", len(summaries), len(groups)
+            )
+            summaries = await self._summarize_all(groups, model)
+
+        return await self._generate_final_summary(
+            " ".join(summaries), on_progress, model
+        )
+
+    def _group_summaries(self, summaries):
+        groups = []
+        current = []
+        current_tokens = 0
+        for summary in summaries:
+            tokens = estimate_tokens(summary)
+            if current and (
+                len(current) >= self.fan_in
+                or (
+                    len(current) >= 2
+                    and current_tokens + tokens > self.max_chunk_tokens
+                )
+            ):
+                groups.append(" ".join(current))
+                current, current_tokens = [], 0
+            current.append(summary)
+            current_tokens += tokens
+        if current:
+            groups.append(" ".join(current))
+        return groups
+
+    async def _summarize_all(self, chunks, model):
+        # Results keep chunk order; at most `concurrency` generations in flight
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        async def summarize(chunk):
+            async with semaphore:
+                summary = await self._generate_summary(chunk, model)
+            logger.debug("Summary generated: %.100s...", summary, extra=SAMPLED)
+            return summary
+
+        return await asyncio.gather(*(summarize(chunk) for chunk in chunks))
+
+    @retry(
+        stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
+    )
+    async def _generate_summary(self, chunk, model):
+        return await self._cached_generate(SUMMARY_PROMPT, chunk, None, model)
+
+    @retry(
+        stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
+    )
+    async def _generate_final_summary(self, text, on_progress, model):
+        return await self._cached_generate(
+            FINAL_SUMMARY_PROMPT, text, on_progress, model
+        )
+
+    async def _cached_generate(self, template, text, on_progress, model):
+        key = None
+        if self.cache:
+            key = self.cache.make_key(model, template, text)
+            cached = await self.cache.get(key)
+            SUMMARY_CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+            if cached is not None:
+                return cached
+
+        started = time.monotonic()
+        summary = await self.backend.generate(
+            template.format(text=text),
+            model,
+            on_progress if self.stream else None,
+            self.options,
+            self.keep_alive,
+        )
+        if self.cache and summary:
+            await self.cache.set(key, summary, model, time.monotonic() - started)
+        return summary
+
+
+ollama_client = OllamaClient(build_backend_pool())
 logger.info("OllamaClient initialized")
+
+Counter(
+    "summary_cache_saved_seconds_total",
+    "LLM generation time saved by summary cache hits.",
+    callback=lambda: ollama_client.cache.saved_seconds if ollama_client.cache else 0,
+)
@@ -0,0 +1,115 @@
+import asyncio
+import base64
+import json
+import logging
+import time
+from api_clients.mail_tm import mail_tm_client, MailTMUnauthorized
+from metrics import Counter, Gauge
+from config import MAIL_TM_TOKEN_REFRESH_MARGIN, MAIL_TM_TOKEN_DEFAULT_TTL
+
+logger = logging.getLogger(__name__)
+
+
+def jwt_expiry(token, default_ttl=MAIL_TM_TOKEN_DEFAULT_TTL):
+    # We only need the `exp` claim to schedule a refresh, so the payload is
+    # decoded without verifying the signature.
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_ttl
+
+
+class TokenCache:
+    def __init__(self, client, refresh_margin=MAIL_TM_TOKEN_REFRESH_MARGIN):
+        self.client = client
+        self.refresh_margin = refresh_margin
+        # Optional persistent backend with load(address) -> (token, exp) | None
+        # and save(address, token, exp); see database/token_store.py.
+        self.store = None
+        self._tokens = {}
+        self._locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def _is_fresh(self, entry):
+        return entry is not None and entry[1] - self.refresh_margin > time.time()
+
+    async def get(self, address, password, force_refresh=False):
+        lock = self._locks.setdefault(address, asyncio.Lock())
+        async with lock:
+            entry = self._tokens.get(address)
+            if not force_refresh and not self._is_fresh(entry) and self.store:
+                entry = await self.store.load(address)
+                if self._is_fresh(entry):
+                    self._tokens[address] = entry
+            if not force_refresh and self._is_fresh(entry):
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            if force_refresh:
+                self.refreshes += 1
+            token = await self.client.get_token(address, password)
+            if not token:
+                self._tokens.pop(address, None)
+                return None
+            entry = (token, jwt_expiry(token))
+            self._tokens[address] = entry
+            if self.store:
+                await self.store.save(address, *entry)
+            return token
+
+    async def put(self, address, token):
+        entry = (token, jwt_expiry(token))
+        self._tokens[address] = entry
+        if self.store:
+            await self.store.save(address, *entry)
+
+    def invalidate(self, address):
+        self._tokens.pop(address, None)
+
+    async def call(self, address, password, func):
+        # Runs func(token), fetching a fresh token and retrying once if mail.tm
+        # answers 401 (revoked or expired earlier than its `exp` claim).
+        token = await self.get(address, password)
+        if not token:
+            return None
+        try:
+            return await func(token)
+        except MailTMUnauthorized:
+            logger.info("Token for %s rejected, refreshing", address)
+            token = await self.get(address, password, force_refresh=True)
+            if not token:
+                return None
+            return await func(token)
+
+    def stats(self):
+        return {
+            "size": len(self._tokens),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+        }
+
+
+token_cache = TokenCache(mail_tm_client)
+
+Counter(
+    "mail_tm_token_cache_total",
+    "mail.tm token lookups (hit, miss) and token refreshes.",
+    ("result",),
+    callback=lambda: {
+        ("hit",): token_cache.hits,
+        ("miss",): token_cache.misses,
+        ("refresh",): token_cache.refreshes,
+    },
+)
+Gauge(
+    "mail_tm_token_cache_size",
+    "mail.tm tokens held in memory.",
+    callback=lambda: token_cache.stats()["size"],
+)
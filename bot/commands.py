@@ -1,4 +1,5 @@
 # bot/commands.py
+import asyncio
 import logging
 import secrets
 import string
@@ -9,11 +10,18 @@ from telegram.ext import (
     CallbackQueryHandler,
     CommandHandler,
 )
-from database.models import get_session, User, Mailbox, SummaryFrequency
+from database.models import get_session, Mailbox, SummaryFrequency
+from database.repository import (
+    get_user_with_mailboxes,
+    get_or_create_user,
+    get_mailbox,
+)
 from api_clients.mail_tm import mail_tm_client
-from tasks import process_single_mailbox, process_user_mailboxes
+from api_clients.token_cache import token_cache
+from api_clients.ollama import ollama_client
+from tasks import mailbox_pool
+from config import LLM_MODEL, LLM_MODELS
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -26,7 +34,7 @@ async def create_mailbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     tag = context.args[0] if context.args else None
 
-    logger.debug(f"Received create_mailbox command. Chat ID: {chat_id}, Tag: {tag}")
+    logger.debug("Received create_mailbox command. Chat ID: %s, Tag: %s", chat_id, tag)
 
     if not tag:
         await update.message.reply_text(
@@ -36,11 +44,7 @@ async def create_mailbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     session = get_session()
     try:
-        user = session.query(User).filter_by(chat_id=str(chat_id)).first()
-        if not user:
-            user = User(chat_id=str(chat_id))
-            session.add(user)
-            session.commit()
+        user = await get_or_create_user(session, chat_id)
 
         if len(user.mailboxes) >= 3:
             await update.message.reply_text(
@@ -67,7 +71,9 @@ async def create_mailbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if token:
                 mailbox = Mailbox(email=email, password=password, tag=tag, user=user)
                 session.add(mailbox)
-                session.commit()
+                await session.commit()
+                # Seed the cache so the first scheduled fetch reuses this token
+                await token_cache.put(email, token)
                 await update.message.reply_text(
                     f"Mailbox created successfully:\nEmail: {email}\nPassword: {password}\nPlease save these credentials securely."
                 )
@@ -81,18 +87,18 @@ async def create_mailbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
     except Exception as e:
         await update.message.reply_text("An error occurred while creating the mailbox.")
-        print(f"Error: {e}")
+        logger.error("Error creating mailbox for chat_id %s: %s", chat_id, e)
     finally:
-        session.close()
+        await session.close()
 
 
 async def list_mailboxes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    logger.debug(f"Received list_mailboxes command. Chat ID: {chat_id}")
+    logger.debug("Received list_mailboxes command. Chat ID: %s", chat_id)
 
     session = get_session()
     try:
-        user = session.query(User).filter_by(chat_id=str(chat_id)).first()
+        user = await get_user_with_mailboxes(session, chat_id)
         if not user:
             await update.message.reply_text(
                 "You don't have any mailboxes yet. Use /create_mailbox to create one."
@@ -107,18 +113,60 @@ async def list_mailboxes(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             mailbox_list = "\n".join(
                 [
-                    f"Email: {mb.email}, Tag: {mb.tag}, Frequency: {mb.summary_frequency}"
+                    f"Email: {mb.email}, Tag: {mb.tag}, Frequency: {mb.summary_frequency}, Model: {ollama_client.model_for(mb.model)}"
                     for mb in mailboxes
                 ]
             )
             await update.message.reply_text(f"Your mailboxes:\n\n{mailbox_list}")
-    except Exception as e:
+    except Exception:
         logger.exception("An error occurred while listing mailboxes")
         await update.message.reply_text(
             "An error occurred while listing your mailboxes. Please try again later."
         )
     finally:
-        session.close()
+        await session.close()
+
+
+async def set_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    logger.debug("Received set_model command. Chat ID: %s, Args: %s", chat_id, args)
+
+    if not args or len(args) > 2:
+        await update.message.reply_text(
+            "Usage: /set_model <tag> [model]\n"
+            f"Available models: {', '.join(LLM_MODELS)}\n"
+            f"Leave out the model to go back to the default ({LLM_MODEL})."
+        )
+        return
+    tag = args[0]
+    model = args[1] if len(args) == 2 else None
+    if model and model not in LLM_MODELS:
+        await update.message.reply_text(
+            f"Unknown model. Available models: {', '.join(LLM_MODELS)}"
+        )
+        return
+
+    session = get_session()
+    try:
+        user = await get_user_with_mailboxes(session, chat_id)
+        mailboxes = [mb for mb in (user.mailboxes if user else []) if mb.tag == tag]
+        if not mailboxes:
+            await update.message.reply_text(f"No mailbox with tag {tag}.")
+            return
+        for mailbox in mailboxes:
+            mailbox.model = model
+        await session.commit()
+        await update.message.reply_text(
+            f"Summaries for {tag} will use {model or LLM_MODEL}."
+        )
+    except Exception:
+        logger.exception("An error occurred while setting the model")
+        await update.message.reply_text(
+            "An error occurred while setting the model. Please try again later."
+        )
+    finally:
+        await session.close()
 
 
 # Define conversation states
@@ -127,11 +175,11 @@ SELECTING_MAILBOX, SELECTING_FREQUENCY = range(2)
 
 async def set_frequency(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    logger.debug(f"Received set_frequency command. Chat ID: {chat_id}")
+    logger.debug("Received set_frequency command. Chat ID: %s", chat_id)
 
     session = get_session()
     try:
-        user = session.query(User).filter_by(chat_id=str(chat_id)).first()
+        user = await get_user_with_mailboxes(session, chat_id)
         if not user or not user.mailboxes:
             await update.message.reply_text(
                 "You don't have any mailboxes yet. Use /create_mailbox to create one."
@@ -152,12 +200,12 @@ async def set_frequency(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Select a mailbox to set frequency:", reply_markup=reply_markup
         )
         return SELECTING_MAILBOX
-    except Exception as e:
+    except Exception:
         logger.exception("An error occurred while setting frequency")
         await update.message.reply_text("An error occurred. Please try again later.")
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
 
 
 async def mailbox_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -185,31 +233,24 @@ async def frequency_selected(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     session = get_session()
     try:
-        mailbox = session.query(Mailbox).filter_by(id=mailbox_id).first()
+        mailbox = await get_mailbox(session, mailbox_id)
         if mailbox:
+            email = mailbox.email
             mailbox.summary_frequency = SummaryFrequency[frequency.upper()]
-            session.commit()
-
-            # Schedule or reschedule the job for this user
-            user = mailbox.user
-            next_run = min(mb.next_summary_time for mb in user.mailboxes)
-            context.job_queue.run_once(
-                process_user_mailboxes,
-                when=next_run,
-                data={"user_id": user.id},
-                name=f"user_{user.id}_summary",
-            )
+            await session.commit()
+            # No job to (re)schedule: the due-mailbox sweeper picks the
+            # mailbox up from next_summary_time.
 
             await query.edit_message_text(
-                f"Frequency for mailbox {mailbox.email} set to {frequency}."
+                f"Frequency for mailbox {email} set to {frequency}."
             )
         else:
             await query.edit_message_text("Mailbox not found. Please try again.")
-    except Exception as e:
+    except Exception:
         logger.exception("An error occurred while setting frequency")
         await query.edit_message_text("An error occurred. Please try again later.")
     finally:
-        session.close()
+        await session.close()
     return ConversationHandler.END
 
 
@@ -233,28 +274,39 @@ SELECTING_MAILBOX_FOR_SUMMARY = 1
 
 async def trigger_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    logger.info(f"Triggering summary for chat_id: {chat_id}")
-    session = get_session()
+    logger.info("Triggering summary for chat_id: %s", chat_id)
     try:
-        user = session.query(User).filter_by(chat_id=str(chat_id)).first()
-        if not user or not user.mailboxes:
+        # Only what's needed is copied out so the session (and its pooled
+        # connection) is closed before the mailbox is processed
+        session = get_session()
+        try:
+            user = await get_user_with_mailboxes(session, chat_id)
+            mailboxes = (
+                [(mb.id, mb.email, mb.tag) for mb in user.mailboxes] if user else []
+            )
+        finally:
+            await session.close()
+
+        if not mailboxes:
             await update.message.reply_text("You don't have any mailboxes set up.")
             return ConversationHandler.END
 
-        if len(user.mailboxes) == 1:
-            # If there's only one mailbox, process it directly
-            mailbox = user.mailboxes[0]
-            await process_single_mailbox(context.bot, chat_id, mailbox.id)
+        if len(mailboxes) == 1:
+            # If there's only one mailbox, process it directly. Going through
+            # the pool joins a run of it that is already queued or running;
+            # processing reports its own progress, so no need to wait here.
+            mailbox_id = mailboxes[0][0]
+            await mailbox_pool.submit(context.bot, chat_id, mailbox_id, urgent=True)
             return ConversationHandler.END
 
         # If there are multiple mailboxes, let the user choose
         keyboard = [
             [
                 InlineKeyboardButton(
-                    f"{mb.email} ({mb.tag})", callback_data=f"summary:{mb.id}"
+                    f"{email} ({tag})", callback_data=f"summary:{mailbox_id}"
                 )
             ]
-            for mb in user.mailboxes
+            for mailbox_id, email, tag in mailboxes
         ]
         keyboard.append(
             [InlineKeyboardButton("All Mailboxes", callback_data="summary:all")]
@@ -266,11 +318,26 @@ async def trigger_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return SELECTING_MAILBOX_FOR_SUMMARY
 
     except Exception as e:
-        logger.error(f"Error in trigger_summary: {str(e)}")
+        logger.error("Error in trigger_summary: %s", e)
         await update.message.reply_text("An error occurred. Please try again later.")
         return ConversationHandler.END
-    finally:
-        session.close()
+
+
+async def _process_in_background(context, chat_id, mailbox_ids, done_text):
+    # Queues the mailboxes ahead of scheduled work and returns at once: the
+    # handler must not wait for processing, since updates from this chat are
+    # handled one at a time and would all wait behind it.
+    futures = [
+        await mailbox_pool.submit(context.bot, chat_id, mailbox_id, urgent=True)
+        for mailbox_id in reversed(mailbox_ids)
+    ]
+
+    async def notify():
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        if not any(isinstance(result, asyncio.CancelledError) for result in results):
+            await context.bot.send_message(chat_id=chat_id, text=done_text)
+
+    context.application.create_task(notify())
 
 
 async def mailbox_selected_for_summary(
@@ -288,27 +355,27 @@ async def mailbox_selected_for_summary(
         if selection == "all":
             session = get_session()
             try:
-                user = session.query(User).filter_by(chat_id=str(chat_id)).first()
-                if user and user.mailboxes:
-                    for mailbox in user.mailboxes:
-                        await process_single_mailbox(context.bot, chat_id, mailbox.id)
-                    await context.bot.send_message(
-                        chat_id=chat_id, text="All mailboxes have been processed."
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=chat_id, text="No mailboxes found for processing."
-                    )
+                user = await get_user_with_mailboxes(session, chat_id)
+                mailbox_ids = [mailbox.id for mailbox in user.mailboxes] if user else []
             finally:
-                session.close()
+                await session.close()
+            if mailbox_ids:
+                await _process_in_background(
+                    context,
+                    chat_id,
+                    mailbox_ids,
+                    "All mailboxes have been processed.",
+                )
+            else:
+                await context.bot.send_message(
+                    chat_id=chat_id, text="No mailboxes found for processing."
+                )
         else:
-            mailbox_id = int(selection)
-            await process_single_mailbox(context.bot, chat_id, mailbox_id)
-            await context.bot.send_message(
-                chat_id=chat_id, text="Mailbox has been processed."
+            await _process_in_background(
+                context, chat_id, [int(selection)], "Mailbox has been processed."
             )
     except Exception as e:
-        logger.error(f"Error in mailbox_selected_for_summary: {str(e)}")
+        logger.error("Error in mailbox_selected_for_summary: %s", e)
         await context.bot.send_message(
             chat_id=chat_id,
             text="An error occurred while processing your request. Please try again later.",
@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import re
+import time
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter, NetworkError
+from bot.progress import retry_after_seconds
+from cpu_pool import cpu_pool
+from metrics import TELEGRAM_SEND_SECONDS, Counter, Gauge
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_SENDERS,
+    TELEGRAM_MAX_ATTEMPTS,
+)
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_BREAK_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def _split_oversized(paragraph, limit, formatter):
+    # A single paragraph that doesn't fit: break it into sentences, then
+    # words, packing as many as fit once formatted.
+    pieces = SENTENCE_BREAK_RE.split(paragraph)
+    if len(pieces) == 1:
+        pieces = paragraph.split(" ")
+    parts = []
+    current = ""
+    for piece in pieces:
+        candidate = f"{current} {piece}" if current else piece
+        if current and len(formatter(candidate)) > limit:
+            parts.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    # Words longer than the limit on their own are hard-cut as a last resort
+    result = []
+    for part in parts:
+        while len(formatter(part)) > limit:
+            cut = limit // 2
+            result.append(part[:cut])
+            part = part[cut:]
+        result.append(part)
+    return result
+
+
+def split_message(text, formatter, limit=MessageLimit.MAX_TEXT_LENGTH):
+    # Splits raw summary text on paragraph boundaries and formats every part
+    # on its own. Each message is therefore a complete MarkdownV2 document:
+    # entities never straddle two messages, and an unmatched marker left by a
+    # forced split is escaped by the formatter like any other literal.
+    # Returns (formatted, raw) pairs.
+    paragraphs = [p for p in re.split(r"\n\s*\n", text) if p.strip()]
+    units = []
+    for paragraph in paragraphs:
+        if len(formatter(paragraph)) > limit:
+            units.extend(_split_oversized(paragraph, limit, formatter))
+        else:
+            units.append(paragraph)
+
+    messages = []
+    current = []
+    for unit in units:
+        candidate = "\n\n".join(current + [unit])
+        if current and len(formatter(candidate)) > limit:
+            raw = "\n\n".join(current)
+            messages.append((formatter(raw), raw))
+            current = [unit]
+        else:
+            current.append(unit)
+    if current:
+        raw = "\n\n".join(current)
+        messages.append((formatter(raw), raw))
+    return messages
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self):
+        # Seconds until a token is available (0 means take one now)
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _Job:
+    def __init__(self, bot, chat_id, parts, parse_mode, future):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.parts = parts  # list of (formatted, raw)
+        self.parse_mode = parse_mode
+        self.future = future
+        self.next_part = 0
+        self.attempts = 0
+        self.plain_parts = set()
+
+
+class DeliveryQueue:
+    # Outbound Telegram messages go through a queue served by a few sender
+    # tasks. Every send takes a token from the chat's bucket and from the
+    # global bucket; RetryAfter blocks the affected bucket and requeues the
+    # job, which resumes at the part that failed so parts stay in order.
+
+    def __init__(
+        self,
+        senders=TELEGRAM_SENDERS,
+        global_rate=TELEGRAM_GLOBAL_RATE,
+        chat_rate=TELEGRAM_CHAT_RATE,
+        chat_burst=TELEGRAM_CHAT_BURST,
+        max_attempts=TELEGRAM_MAX_ATTEMPTS,
+    ):
+        self.senders = senders
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._queue = None
+        self._tasks = []
+        # Jobs waiting out a flood wait or backoff before going back on the
+        # queue, and the futures of every job not yet settled
+        self._requeues = set()
+        self._pending = set()
+        self._started_at = None
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._started_at = time.monotonic()
+        self._tasks = [
+            asyncio.create_task(self._sender(i)) for i in range(max(1, self.senders))
+        ]
+
+    async def stop(self):
+        tasks = self._tasks + list(self._requeues)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._requeues.clear()
+        # Whatever wasn't delivered by now never will be; don't leave the
+        # callers of send() waiting forever
+        for future in self._pending:
+            if not future.done():
+                future.set_result(False)
+        self._pending.clear()
+
+    async def send(self, bot, chat_id, text, formatter=None, parse_mode=None):
+        # Queues `text` (split as needed) and waits until every part has been
+        # delivered or given up on. Returns True on full delivery.
+        self.start()
+        # The formatter must be picklable (a module-level function or a
+        # functools.partial of one) since splitting may run in a process pool
+        parts = await cpu_pool.run(
+            split_message, text, formatter or str, size=len(text)
+        )
+        future = asyncio.get_running_loop().create_future()
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        await self._queue.put(_Job(bot, chat_id, parts, parse_mode, future))
+        return await future
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "waiting_retry": len(self._requeues),
+            "messages_per_second": round(self.sent / elapsed, 2) if elapsed else 0.0,
+        }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule_requeue(self, job, delay):
+        # A reference is kept so the task isn't garbage collected mid-sleep
+        # and so stop() can cancel it
+        task = asyncio.create_task(self._requeue(job, delay))
+        self._requeues.add(task)
+        task.add_done_callback(self._requeues.discard)
+
+    async def _requeue(self, job, delay):
+        await asyncio.sleep(delay)
+        await self._queue.put(job)
+
+    async def _sender(self, index):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._deliver(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Sender %s failed on chat %s: %s", index, job.chat_id, e)
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_result(False)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job):
+        chat_bucket = self._chat_bucket(job.chat_id)
+        while job.next_part < len(job.parts):
+            formatted, raw = job.parts[job.next_part]
+            plain = job.next_part in job.plain_parts
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                with TELEGRAM_SEND_SECONDS.time(outcome="error") as timing:
+                    await job.bot.send_message(
+                        chat_id=job.chat_id,
+                        text=raw if plain else formatted,
+                        parse_mode=None if plain else job.parse_mode,
+                    )
+                    timing["outcome"] = "ok"
+            except RetryAfter as e:
+                seconds = retry_after_seconds(e)
+                chat_bucket.block(seconds)
+                if self._retry(job, f"flood wait {seconds}s"):
+                    self._schedule_requeue(job, seconds)
+                return
+            except BadRequest as e:
+                if plain or job.parse_mode is None:
+                    raise
+                # Formatting rejected: deliver this part as plain text instead
+                logger.warning("Sending part as plain text to %s: %s", job.chat_id, e)
+                job.plain_parts.add(job.next_part)
+                continue
+            except NetworkError as e:
+                if self._retry(job, str(e)):
+                    delay = min(60, 2**job.attempts)
+                    self._schedule_requeue(job, delay)
+                return
+            self.sent += 1
+            job.next_part += 1
+        if not job.future.done():
+            job.future.set_result(True)
+
+    def _retry(self, job, reason):
+        job.attempts += 1
+        if job.attempts >= self.max_attempts:
+            logger.error(
+                "Giving up on message to %s after %s attempts: %s",
+                job.chat_id,
+                job.attempts,
+                reason,
+            )
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_result(False)
+            return False
+        self.retries += 1
+        return True
+
+
+delivery_queue = DeliveryQueue()
+
+Gauge(
+    "telegram_delivery_queue_depth",
+    "Messages waiting to be sent.",
+    callback=lambda: delivery_queue.stats()["queue_depth"],
+)
+Gauge(
+    "telegram_delivery_waiting_retry",
+    "Messages waiting out a flood wait or backoff before being retried.",
+    callback=lambda: delivery_queue.stats()["waiting_retry"],
+)
+Counter(
+    "telegram_delivery_total",
+    "Message parts sent, messages given up on, and retries scheduled.",
+    ("result",),
+    callback=lambda: {
+        ("sent",): delivery_queue.sent,
+        ("failed",): delivery_queue.failed,
+        ("retried",): delivery_queue.retries,
+    },
+)
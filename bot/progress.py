@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+from config import TELEGRAM_EDIT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_NOTE = "Summary ready, see below."
+
+
+def retry_after_seconds(error):
+    # python-telegram-bot reports retry_after as int seconds or a timedelta
+    # depending on version and settings.
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class ProgressiveMessage:
+    # Keeps one Telegram message updated with a growing text. Edits are
+    # throttled to one per `min_interval` seconds and paused entirely while
+    # Telegram's flood control (RetryAfter) is in effect; intermediate updates
+    # in between are simply dropped, the next one carries the latest text.
+
+    def __init__(self, bot, chat_id, message_id, min_interval=TELEGRAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.edits = 0
+        self._last_edit = 0.0
+        self._blocked_until = 0.0
+        self._last_text = None
+
+    async def update(self, text):
+        now = time.monotonic()
+        if now - self._last_edit < self.min_interval or now < self._blocked_until:
+            return
+        limit = MessageLimit.MAX_TEXT_LENGTH - 2
+        if len(text) > limit:
+            text = "…" + text[-(limit - 1) :]
+        await self._edit(f"{text} …")
+
+    async def finish(self, text, parse_mode=None):
+        # Replaces the progress text with the final one. Returns False when
+        # the caller has to deliver the text another way (too long, or the
+        # edit failed); the progress message then gets FALLBACK_NOTE instead
+        # of being left with the truncated draft.
+        if len(text) <= MessageLimit.MAX_TEXT_LENGTH:
+            await self._wait_for_flood_control()
+            if await self._edit(text, parse_mode):
+                return True
+            if await self._wait_for_flood_control():
+                if await self._edit(text, parse_mode):
+                    return True
+        await self._wait_for_flood_control()
+        await self._edit(FALLBACK_NOTE)
+        return False
+
+    async def _wait_for_flood_control(self):
+        wait = self._blocked_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+            return True
+        return False
+
+    async def _edit(self, text, parse_mode=None):
+        if text == self._last_text:
+            return True
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=text,
+                parse_mode=parse_mode,
+            )
+        except RetryAfter as e:
+            self._blocked_until = time.monotonic() + retry_after_seconds(e)
+            logger.warning("Edit rate limited in chat %s: %s", self.chat_id, e)
+            return False
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return True
+            logger.error(
+                "Failed to edit progress message in chat %s: %s", self.chat_id, e
+            )
+            return False
+        self._last_edit = time.monotonic()
+        self._last_text = text
+        self.edits += 1
+        return True
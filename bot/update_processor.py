@@ -0,0 +1,49 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates allowed to wait for their chat's turn; only bounds memory
+MAX_PENDING_UPDATES = 4096
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Processes updates from different chats concurrently but the updates of
+    # one chat strictly one after another, in arrival order. The
+    # ConversationHandlers (set_frequency, trigger_summary) keep per-chat
+    # state and rely on seeing a chat's updates one by one, which PTB's
+    # plain concurrent_updates doesn't guarantee.
+    #
+    # PTB's own semaphore is taken before the chat lock, so it is set high
+    # enough to only bound pending updates; `max_running` caps the handlers
+    # actually running, and is taken after the chat lock so updates queued
+    # behind one busy chat never hold a slot other chats could use.
+
+    def __init__(self, max_running):
+        super().__init__(max(MAX_PENDING_UPDATES, max_running))
+        self.max_running = max_running
+        self._running = asyncio.Semaphore(max_running)
+        # chat id -> [lock, number of updates holding or waiting for it]
+        self._chats = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
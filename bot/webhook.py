@@ -0,0 +1,89 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+from aiohttp import web
+from telegram import Update
+from config import (
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_webhook_app(application, secret_token, path=WEBHOOK_PATH):
+    # Telegram POSTs each update as JSON and sends the secret we registered
+    # with setWebhook in a header; anything else is rejected before parsing.
+    async def receive_update(request):
+        received = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(received.encode(), secret_token.encode()):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Queue and answer at once; the application processes updates
+        # concurrently (TELEGRAM_CONCURRENT_UPDATES), so a slow handler never
+        # holds up Telegram's delivery of the next one.
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    async def health(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get("/healthz", health)
+    return app
+
+
+async def run_webhook(application):
+    # Webhook counterpart of application.run_polling(): same post_init /
+    # post_shutdown lifecycle, with updates arriving over HTTP instead.
+    secret_token = WEBHOOK_SECRET_TOKEN
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning(
+            "WEBHOOK_SECRET_TOKEN is not set, using a random one. Set it "
+            "explicitly when running several instances behind a load balancer."
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(make_webhook_app(application, secret_token))
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        logger.info(
+            "Webhook listening on %s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH
+        )
+        await stop.wait()
+    finally:
+        logger.info("Shutting down webhook server")
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -8,3 +8,130 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///bot.db")
 MAIL_TM_API_URL = os.getenv("MAIL_TM_API_URL", "https://api.mail.tm")
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434")
+
+# mail.tm HTTP connection pool
+MAIL_TM_CONN_LIMIT = int(os.getenv("MAIL_TM_CONN_LIMIT", "100"))
+MAIL_TM_CONN_LIMIT_PER_HOST = int(os.getenv("MAIL_TM_CONN_LIMIT_PER_HOST", "20"))
+MAIL_TM_DNS_CACHE_TTL = int(os.getenv("MAIL_TM_DNS_CACHE_TTL", "300"))
+MAIL_TM_KEEPALIVE_TIMEOUT = float(os.getenv("MAIL_TM_KEEPALIVE_TIMEOUT", "30"))
+# Max concurrent per-message requests (body fetch / mark as read) per mailbox
+MAIL_TM_MESSAGE_CONCURRENCY = int(os.getenv("MAIL_TM_MESSAGE_CONCURRENCY", "8"))
+
+# mail.tm JWT cache
+MAIL_TM_TOKEN_REFRESH_MARGIN = int(os.getenv("MAIL_TM_TOKEN_REFRESH_MARGIN", "60"))
+MAIL_TM_TOKEN_DEFAULT_TTL = int(os.getenv("MAIL_TM_TOKEN_DEFAULT_TTL", "3600"))
+MAIL_TM_TOKEN_PERSIST = os.getenv("MAIL_TM_TOKEN_PERSIST", "false").lower() == "true"
+
+# Ollama summarization
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "4"))
+OLLAMA_REDUCE_FAN_IN = int(os.getenv("OLLAMA_REDUCE_FAN_IN", "4"))
+
+# Summary cache shared across users and mailboxes
+SUMMARY_CACHE_ENABLED = os.getenv("SUMMARY_CACHE_ENABLED", "true").lower() == "true"
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "50000"))
+SUMMARY_CACHE_TTL_DAYS = int(os.getenv("SUMMARY_CACHE_TTL_DAYS", "30"))
+OLLAMA_CHUNK_TOKENS = int(os.getenv("OLLAMA_CHUNK_TOKENS", "2000"))
+OLLAMA_CHUNK_OVERLAP_TOKENS = int(os.getenv("OLLAMA_CHUNK_OVERLAP_TOKENS", "0"))
+
+# Scheduler worker pool
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "8"))
+SCHEDULER_PER_USER_CONCURRENCY = int(os.getenv("SCHEDULER_PER_USER_CONCURRENCY", "2"))
+# Global caps shared by all workers
+MAIL_TM_MAILBOX_CONCURRENCY = int(os.getenv("MAIL_TM_MAILBOX_CONCURRENCY", "8"))
+OLLAMA_MAX_GENERATIONS = int(os.getenv("OLLAMA_MAX_GENERATIONS", "4"))
+# Due-mailbox sweeper
+SCHEDULER_SWEEP_INTERVAL = int(os.getenv("SCHEDULER_SWEEP_INTERVAL", "60"))
+SCHEDULER_SWEEP_BATCH = int(os.getenv("SCHEDULER_SWEEP_BATCH", "500"))
+SCHEDULER_MAX_QUEUED = int(os.getenv("SCHEDULER_MAX_QUEUED", "5000"))
+
+# Database engine tuning
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Streaming summaries into a live Telegram message
+OLLAMA_STREAM = os.getenv("OLLAMA_STREAM", "true").lower() == "true"
+TELEGRAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_EDIT_INTERVAL", "1.5"))
+
+# Outbound Telegram delivery
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_SENDERS = int(os.getenv("TELEGRAM_SENDERS", "4"))
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_MAX_ATTEMPTS", "5"))
+# "MarkdownV2" or "HTML"
+TELEGRAM_PARSE_MODE = os.getenv("TELEGRAM_PARSE_MODE", "MarkdownV2")
+
+# LLM backends. OLLAMA_API_URL and OPENAI_API_URL accept a comma-separated
+# list of hosts; requests go to the healthy host with the fewest in flight.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "ollama")  # "ollama" or "openai"
+LLM_MODEL = os.getenv("LLM_MODEL", "gemma2:2b")
+# Models /set_model may pick from (comma-separated); LLM_MODEL always is one
+LLM_MODELS = [LLM_MODEL] + [
+    model.strip()
+    for model in os.getenv("LLM_MODELS", "").split(",")
+    if model.strip() and model.strip() != LLM_MODEL
+]
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "http://localhost:8000/v1")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+LLM_HEALTH_CHECK_INTERVAL = int(os.getenv("LLM_HEALTH_CHECK_INTERVAL", "30"))
+
+# Ollama generation options; leave NUM_PREDICT/TEMPERATURE unset for the
+# model defaults. A larger NUM_CTX allows a larger OLLAMA_CHUNK_TOKENS.
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "8192"))
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "0")) or None
+OLLAMA_TEMPERATURE = (
+    float(os.getenv("OLLAMA_TEMPERATURE")) if os.getenv("OLLAMA_TEMPERATURE") else None
+)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_WARM_UP = os.getenv("OLLAMA_WARM_UP", "true").lower() == "true"
+# Upper bound for one model load during warm-up, in seconds
+OLLAMA_WARM_UP_TIMEOUT = int(os.getenv("OLLAMA_WARM_UP_TIMEOUT", "300"))
+
+# Digested per-email summaries are kept this long to skip duplicates
+EMAIL_SUMMARY_RETENTION_DAYS = int(os.getenv("EMAIL_SUMMARY_RETENTION_DAYS", "30"))
+
+# How updates reach the bot: "polling" or "webhook"
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+# Updates handled at once, across chats; one chat's updates run in order
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "32"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public https base URL
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Mailbox jobs are claimed through lease rows so several bot processes can
+# share one database without processing a mailbox twice.
+WORKER_ID = os.getenv("WORKER_ID", "")  # defaults to hostname:pid
+SCHEDULER_LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", "300"))
+# Mailboxes one sweep may claim; 0 means as many as the queue can take.
+# With several processes, a small value (e.g. 2x SCHEDULER_WORKERS) and a
+# shorter SCHEDULER_SWEEP_INTERVAL spread the work more evenly.
+SCHEDULER_CLAIM_LIMIT = int(os.getenv("SCHEDULER_CLAIM_LIMIT", "0"))
+
+# CPU-bound text work (HTML cleanup, chunking, formatting) runs off the event
+# loop: "process", "thread" or "inline"
+CPU_POOL = os.getenv("CPU_POOL", "process")
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", "0"))  # 0: min(4, CPUs)
+# Inputs shorter than this are processed inline
+CPU_OFFLOAD_MIN_CHARS = int(os.getenv("CPU_OFFLOAD_MIN_CHARS", "20000"))
+# Event loop lag sampling; 0 disables it
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "100"))
+
+# Prometheus metrics on http://METRICS_LISTEN:METRICS_PORT/metrics; 0 disables
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Logging (see logging_setup.py)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+# Longer messages are cut; 0 disables
+LOG_MAX_CHARS = int(os.getenv("LOG_MAX_CHARS", "2000"))
+# Per-message events: only 1 in LOG_SAMPLE_RATE is logged; 1 logs all
+LOG_SAMPLE_RATE = int(os.getenv("LOG_SAMPLE_RATE", "100"))
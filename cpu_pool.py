@@ -0,0 +1,146 @@
+# cpu_pool.py
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from metrics import EVENT_LOOP_LAG_SECONDS
+from config import (
+    CPU_POOL,
+    CPU_POOL_WORKERS,
+    CPU_OFFLOAD_MIN_CHARS,
+    LOOP_LAG_INTERVAL,
+    LOOP_LAG_WARN_MS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _ignore_sigint():
+    # Ctrl-C is handled by the main process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class CPUPool:
+    # Runs CPU-bound text work (HTML cleanup, chunking, Telegram formatting)
+    # off the event loop so a multi-megabyte newsletter doesn't stall update
+    # handling for everyone. `kind` is "process", "thread" or "inline".
+    # Functions sent to a process pool must be module-level (picklable); small
+    # inputs run inline since the round trip would cost more than the work.
+
+    def __init__(
+        self, kind=CPU_POOL, workers=CPU_POOL_WORKERS, min_chars=CPU_OFFLOAD_MIN_CHARS
+    ):
+        if kind not in ("process", "thread", "inline"):
+            raise ValueError(f"Unknown CPU_POOL: {kind}")
+        self.kind = kind
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.min_chars = min_chars
+        self._executor = None
+        self.offloaded = 0
+        self.inline = 0
+        self.offload_seconds = 0.0
+
+    def start(self):
+        if self._executor is not None or self.kind == "inline":
+            return
+        if self.kind == "process":
+            # spawn: forking a process that already runs threads (aiosqlite,
+            # executors) can deadlock the child
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_ignore_sigint,
+            )
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="cpu"
+            )
+        logger.info("CPU pool started (%s, %s workers)", self.kind, self.workers)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func, *args, size=None, **kwargs):
+        # `size` is the input length in characters; None always offloads
+        if self._executor is None or (size is not None and size < self.min_chars):
+            self.inline += 1
+            return func(*args, **kwargs)
+        started = time.monotonic()
+        result = await asyncio.get_running_loop().run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+        self.offloaded += 1
+        self.offload_seconds += time.monotonic() - started
+        return result
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers if self.kind != "inline" else 0,
+            "offloaded": self.offloaded,
+            "inline": self.inline,
+            "offload_avg_ms": (
+                round(self.offload_seconds / self.offloaded * 1000, 1)
+                if self.offloaded
+                else 0.0
+            ),
+        }
+
+
+class LoopLagMonitor:
+    # Sleeps `interval` seconds in a loop and measures how late it wakes up.
+    # The delay is time the event loop spent busy with something else, i.e.
+    # how long any Telegram update arriving then would have waited.
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, warn_ms=LOOP_LAG_WARN_MS):
+        self.interval = interval
+        self.warn_ms = warn_ms
+        self.samples = deque(maxlen=1000)
+        self.max_ms = 0.0
+        self.warnings = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag_ms = (time.monotonic() - started - self.interval) * 1000
+            self.samples.append(lag_ms)
+            EVENT_LOOP_LAG_SECONDS.observe(max(0.0, lag_ms / 1000))
+            self.max_ms = max(self.max_ms, lag_ms)
+            if lag_ms > self.warn_ms:
+                self.warnings += 1
+                logger.warning("Event loop blocked for %.0f ms", lag_ms)
+
+    def stats(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "p50_ms": round(samples[len(samples) // 2], 1),
+            "p99_ms": round(samples[int(len(samples) * 0.99)], 1),
+            "max_ms": round(self.max_ms, 1),
+            "warnings": self.warnings,
+        }
+
+
+cpu_pool = CPUPool()
+loop_monitor = LoopLagMonitor()
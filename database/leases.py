@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from database.models import get_session, MailboxLease
+from config import WORKER_ID, SCHEDULER_LEASE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseManager:
+    # Claims mailbox jobs through the mailbox_leases table. A lease is taken
+    # by inserting its row (or by taking over an expired one) and is kept
+    # alive by a heartbeat that pushes expires_at forward for every lease the
+    # process holds. If the process dies its leases expire after `ttl` and
+    # other workers pick those mailboxes up.
+
+    def __init__(self, owner=None, ttl=SCHEDULER_LEASE_TTL):
+        self.owner = owner or WORKER_ID or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = timedelta(seconds=ttl)
+        self.heartbeat_interval = max(1, ttl // 3)
+        self._task = None
+        # Leases this process holds; only these are kept alive, so a lease
+        # whose release failed still runs out instead of being held forever
+        self._held = set()
+        # Mailboxes being processed right now in this process; a second
+        # claim on one of them fails even though the lease is already ours
+        self._running = set()
+        self.claimed = 0
+        self.contended = 0
+        self.released = 0
+        self.heartbeats = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._held.clear()
+        # Hand back whatever is still held so other workers don't wait out
+        # the TTL after a clean shutdown
+        session = get_session()
+        try:
+            await session.execute(
+                delete(MailboxLease).where(MailboxLease.owner == self.owner)
+            )
+            await session.commit()
+        finally:
+            await session.close()
+
+    def _insert(self, session):
+        dialect = postgresql if session.bind.dialect.name == "postgresql" else sqlite
+        return dialect.insert(MailboxLease)
+
+    async def claim_many(self, session, mailbox_ids):
+        # Claims every mailbox that has no lease or an expired one. Returns
+        # the ids claimed by this call; mailboxes this process already holds
+        # are not included. The caller commits.
+        if not mailbox_ids:
+            return set()
+        now = datetime.utcnow()
+        expires_at = now + self.ttl
+        await session.execute(
+            self._insert(session)
+            .values(
+                [
+                    {
+                        "mailbox_id": mailbox_id,
+                        "owner": self.owner,
+                        "acquired_at": now,
+                        "expires_at": expires_at,
+                    }
+                    for mailbox_id in mailbox_ids
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["mailbox_id"])
+        )
+        await session.execute(
+            update(MailboxLease)
+            .where(
+                MailboxLease.mailbox_id.in_(mailbox_ids),
+                MailboxLease.expires_at < now,
+            )
+            .values(owner=self.owner, acquired_at=now, expires_at=expires_at)
+        )
+        result = await session.scalars(
+            select(MailboxLease.mailbox_id).where(
+                MailboxLease.mailbox_id.in_(mailbox_ids),
+                MailboxLease.owner == self.owner,
+                MailboxLease.acquired_at == now,
+            )
+        )
+        claimed = set(result.all())
+        self._held |= claimed
+        self.claimed += len(claimed)
+        self.contended += len(mailbox_ids) - len(claimed)
+        return claimed
+
+    async def claim(self, mailbox_id):
+        # Single mailbox, in its own transaction, for processing it now.
+        # Succeeds if the lease is free, expired or held by this process for
+        # a mailbox that isn't already being processed here.
+        if mailbox_id in self._running:
+            self.contended += 1
+            return False
+        # Marked before the first await so a concurrent claim sees it
+        self._running.add(mailbox_id)
+        session = get_session()
+        try:
+            now = datetime.utcnow()
+            expires_at = now + self.ttl
+            await session.execute(
+                self._insert(session)
+                .values(
+                    mailbox_id=mailbox_id,
+                    owner=self.owner,
+                    acquired_at=now,
+                    expires_at=expires_at,
+                )
+                .on_conflict_do_nothing(index_elements=["mailbox_id"])
+            )
+            result = await session.execute(
+                update(MailboxLease)
+                .where(
+                    MailboxLease.mailbox_id == mailbox_id,
+                    or_(
+                        MailboxLease.owner == self.owner,
+                        MailboxLease.expires_at < now,
+                    ),
+                )
+                .values(owner=self.owner, expires_at=expires_at)
+            )
+            await session.commit()
+        except Exception:
+            self._running.discard(mailbox_id)
+            raise
+        finally:
+            await session.close()
+        if result.rowcount:
+            self._held.add(mailbox_id)
+            return True
+        self._running.discard(mailbox_id)
+        self.contended += 1
+        return False
+
+    async def release(self, mailbox_ids):
+        # Call only after the mailbox's own updates are committed, so the
+        # worker that claims it next sees them.
+        self._held.difference_update(mailbox_ids)
+        self._running.difference_update(mailbox_ids)
+        session = get_session()
+        try:
+            await session.execute(
+                delete(MailboxLease).where(
+                    MailboxLease.mailbox_id.in_(mailbox_ids),
+                    MailboxLease.owner == self.owner,
+                )
+            )
+            await session.commit()
+        finally:
+            await session.close()
+        self.released += len(mailbox_ids)
+
+    async def heartbeat(self):
+        if not self._held:
+            return 0
+        session = get_session()
+        try:
+            result = await session.execute(
+                update(MailboxLease)
+                .where(
+                    MailboxLease.mailbox_id.in_(self._held),
+                    MailboxLease.owner == self.owner,
+                )
+                .values(expires_at=datetime.utcnow() + self.ttl)
+            )
+            await session.commit()
+            self.heartbeats += 1
+            return result.rowcount
+        finally:
+            await session.close()
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error("Lease heartbeat failed for %s: %s", self.owner, e)
+
+    def stats(self):
+        return {
+            "owner": self.owner,
+            "claimed": self.claimed,
+            "contended": self.contended,
+            "released": self.released,
+            "held": len(self._held),
+            "running": len(self._running),
+            "heartbeats": self.heartbeats,
+        }
+
+
+mailbox_leases = LeaseManager()
@@ -0,0 +1,155 @@
+# database/migrations.py
+#
+# Versioned schema migrations. Run them explicitly before starting the bot:
+#
+#     python -m database.migrations
+#
+# Every step checks the live schema before changing it, so databases created
+# by the old create_all-at-import code are brought up to date safely.
+import asyncio
+import logging
+from datetime import datetime
+from sqlalchemy import (
+    event,
+    inspect,
+    select,
+    Column,
+    Integer,
+    DateTime,
+    MetaData,
+    Table,
+)
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.schema import CreateColumn
+from config import DATABASE_URL
+from database.models import Base, async_database_url, is_sqlite, set_sqlite_pragmas
+from logging_setup import configure_logging
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+
+def _create_table(connection, name):
+    Base.metadata.tables[name].create(connection, checkfirst=True)
+
+
+def _add_column(connection, table_name, column_name):
+    existing = {c["name"] for c in inspect(connection).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = Base.metadata.tables[table_name].c[column_name]
+    ddl = CreateColumn(column).compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {ddl}")
+
+
+def _create_index(connection, table_name, index_name):
+    existing = {i["name"] for i in inspect(connection).get_indexes(table_name)}
+    if index_name in existing:
+        return
+    table = Base.metadata.tables[table_name]
+    next(i for i in table.indexes if i.name == index_name).create(connection)
+
+
+def initial_schema(connection):
+    _create_table(connection, "users")
+    _create_table(connection, "mailboxes")
+
+
+def mailbox_cursor_and_token(connection):
+    for column in ("last_message_at", "token", "token_expires_at"):
+        _add_column(connection, "mailboxes", column)
+
+
+def summary_cache_table(connection):
+    _create_table(connection, "summary_cache")
+
+
+def mailbox_indexes(connection):
+    _create_index(connection, "mailboxes", "ix_mailboxes_next_summary_time")
+    _create_index(connection, "mailboxes", "ix_mailboxes_user_id")
+
+
+def mailbox_model(connection):
+    _add_column(connection, "mailboxes", "model")
+
+
+def email_summaries_table(connection):
+    _create_table(connection, "email_summaries")
+
+
+def mailbox_leases_table(connection):
+    _create_table(connection, "mailbox_leases")
+
+
+MIGRATIONS = [
+    (1, "initial users and mailboxes tables", initial_schema),
+    (2, "mailbox message cursor and cached token", mailbox_cursor_and_token),
+    (3, "summary cache table", summary_cache_table),
+    (4, "mailbox user_id and next_summary_time indexes", mailbox_indexes),
+    (5, "per-mailbox summarization model", mailbox_model),
+    (6, "per-email summaries", email_summaries_table),
+    (7, "mailbox job leases", mailbox_leases_table),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    if not inspect(connection).has_table("schema_version"):
+        return 0
+    versions = connection.execute(select(schema_version.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+async def run_migrations(url=DATABASE_URL):
+    # Goes through the same async driver as the bot (aiosqlite / asyncpg), so
+    # no separate sync driver is needed and postgres:// URLs work too. The
+    # steps themselves are plain sync functions run with run_sync.
+    engine = create_async_engine(async_database_url(url))
+    if is_sqlite(url):
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    try:
+        async with engine.begin() as connection:
+            await connection.run_sync(schema_version.create, checkfirst=True)
+            version = await connection.run_sync(current_version)
+        for number, description, step in MIGRATIONS:
+            if number <= version:
+                continue
+            # One transaction per step so a failure leaves a clean version
+            async with engine.begin() as connection:
+                logger.info("Applying migration %s: %s", number, description)
+                await connection.run_sync(step)
+                await connection.execute(schema_version.insert().values(version=number))
+            version = number
+        logger.info("Database schema is at version %s", version)
+        return version
+    finally:
+        await engine.dispose()
+
+
+def migrate(url=DATABASE_URL):
+    return asyncio.run(run_migrations(url))
+
+
+async def check_schema_version(session):
+    # Cheap startup check: one SELECT against schema_version, no reflection
+    # of the application tables.
+    connection = await session.connection()
+    version = await connection.run_sync(current_version)
+    if version < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema is at version {version}, expected {SCHEMA_VERSION}. "
+            "Run `python -m database.migrations` first."
+        )
+    return version
+
+
+if __name__ == "__main__":
+    configure_logging()
+    migrate()
@@ -1,18 +1,31 @@
 # database/models.py
 from sqlalchemy import (
-    create_engine,
+    event,
     Column,
     Integer,
     String,
     ForeignKey,
     Enum,
     DateTime,
+    Float,
+    Text,
 )
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from config import DATABASE_URL
+from sqlalchemy.orm import relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from config import (
+    DATABASE_URL,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_MMAP_SIZE,
+)
 import enum
+import time
 from datetime import datetime, timedelta
+from metrics import DB_QUERY_SECONDS
 
 Base = declarative_base()
 
@@ -37,11 +50,18 @@ class Mailbox(Base):
     email = Column(String, unique=True, nullable=False)
     tag = Column(String)
     summary_frequency = Column(Enum(SummaryFrequency), default=SummaryFrequency.DAILY)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
     user = relationship("User", back_populates="mailboxes")
     password = Column(String, nullable=False)  # Encrypt this later
     last_summary_sent = Column(DateTime, default=datetime.utcnow)
-    next_summary_time = Column(DateTime, default=datetime.utcnow)
+    next_summary_time = Column(DateTime, default=datetime.utcnow, index=True)
+    # createdAt of the newest message already processed; older ones are skipped
+    last_message_at = Column(DateTime)
+    # Cached mail.tm JWT, only written when MAIL_TM_TOKEN_PERSIST is enabled
+    token = Column(String)
+    token_expires_at = Column(DateTime)
+    # LLM model for this mailbox's digests; NULL means LLM_MODEL
+    model = Column(String)
 
     def calculate_next_summary_time(self):
         if self.summary_frequency == SummaryFrequency.DAILY:
@@ -50,14 +70,121 @@ class Mailbox(Base):
             self.next_summary_time = datetime.utcnow() + timedelta(days=7)
 
 
-# Create the database engine
-engine = create_engine(DATABASE_URL)
+class EmailSummary(Base):
+    __tablename__ = "email_summaries"
+
+    # mail.tm message id
+    message_id = Column(String, primary_key=True)
+    mailbox_id = Column(Integer, ForeignKey("mailboxes.id"), nullable=False, index=True)
+    subject = Column(String)
+    # Cleaned email text, kept only until the email has been summarized
+    body = Column(Text)
+    summary = Column(Text)
+    model = Column(String)
+    received_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Set once the summary has gone out in a digest
+    digested_at = Column(DateTime)
+
+
+class MailboxLease(Base):
+    __tablename__ = "mailbox_leases"
+
+    # One row while a worker process owns the mailbox's summary job
+    mailbox_id = Column(Integer, ForeignKey("mailboxes.id"), primary_key=True)
+    owner = Column(String, nullable=False)
+    acquired_at = Column(DateTime, default=datetime.utcnow)
+    # Pushed forward by the owner's heartbeat; once it passes, any worker may
+    # take the mailbox over
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class SummaryCacheEntry(Base):
+    __tablename__ = "summary_cache"
+
+    # sha256 of (model, prompt template, normalized input text)
+    key = Column(String(64), primary_key=True)
+    model = Column(String)
+    summary = Column(Text, nullable=False)
+    generation_seconds = Column(Float, default=0)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_accessed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+
+def async_database_url(url):
+    # sqlite:///bot.db -> sqlite+aiosqlite:///bot.db, postgresql:// -> asyncpg
+    scheme, sep, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}{sep}{rest}"
+
+
+def is_sqlite(url):
+    return url.startswith("sqlite")
+
+
+def engine_options(url):
+    if not is_sqlite(url):
+        return {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": True,
+        }
+    if ":memory:" in url or url.rstrip("/").endswith("sqlite:"):
+        return {}
+    # WAL lets readers run alongside the single writer, so a small pool of
+    # long-lived connections is enough and keeps the page cache warm.
+    return {"pool_size": DB_POOL_SIZE, "max_overflow": 0}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+# Async engine and session factory used by the bot at runtime. Objects stay
+# usable after commit so handlers can keep reading them without a reload.
+async_engine = create_async_engine(
+    async_database_url(DATABASE_URL), **engine_options(DATABASE_URL)
+)
+
+if is_sqlite(DATABASE_URL):
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
+
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.monotonic()
+
+
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    # Labelled by statement kind (SELECT, INSERT, ...) to keep cardinality low
+    DB_QUERY_SECONDS.observe(
+        time.monotonic() - context._query_started,
+        statement=statement.lstrip().split(None, 1)[0].upper() if statement else "",
+    )
+
+
+event.listen(async_engine.sync_engine, "before_cursor_execute", _query_started)
+event.listen(async_engine.sync_engine, "after_cursor_execute", _query_finished)
 
-# Create all tables
-Base.metadata.create_all(engine)
+# The schema is managed by database/migrations.py; importing this module
+# doesn't touch the database (create_async_engine connects lazily).
 
-# Create a session factory
-Session = sessionmaker(bind=engine)
+Session = async_sessionmaker(async_engine, expire_on_commit=False)
 
 
 def get_session():
@@ -0,0 +1,85 @@
+from sqlalchemy import select, delete
+from sqlalchemy.orm import joinedload
+from database.models import User, Mailbox, EmailSummary
+
+# Single-query accessors. Relationships the callers need are loaded eagerly
+# in the same SELECT so handlers never trigger lazy loads afterwards (which
+# an AsyncSession doesn't allow anyway).
+
+
+async def get_user_with_mailboxes(session, chat_id):
+    result = await session.execute(
+        select(User)
+        .options(joinedload(User.mailboxes))
+        .where(User.chat_id == str(chat_id))
+    )
+    return result.unique().scalars().first()
+
+
+async def get_or_create_user(session, chat_id):
+    user = await get_user_with_mailboxes(session, chat_id)
+    if not user:
+        # Flushed, not committed: the user is saved with its first mailbox
+        user = User(chat_id=str(chat_id), mailboxes=[])
+        session.add(user)
+        await session.flush()
+    return user
+
+
+async def get_mailbox_with_owner(session, mailbox_id):
+    result = await session.execute(
+        select(Mailbox)
+        .options(joinedload(Mailbox.user))
+        .where(Mailbox.id == int(mailbox_id))
+    )
+    return result.scalars().first()
+
+
+async def get_mailbox(session, mailbox_id):
+    return await session.get(Mailbox, int(mailbox_id))
+
+
+async def add_pending_emails(session, mailbox_id, emails):
+    # Stores fetched emails not seen before, unsummarized. Returns how many
+    # were new; emails already stored (summarized or not) are left alone.
+    ids = [email["id"] for email in emails]
+    if not ids:
+        return 0
+    result = await session.scalars(
+        select(EmailSummary.message_id).where(EmailSummary.message_id.in_(ids))
+    )
+    known = set(result.all())
+    new = [
+        EmailSummary(
+            message_id=email["id"],
+            mailbox_id=mailbox_id,
+            subject=email["subject"],
+            body=email["body"],
+            received_at=email.get("created_at"),
+        )
+        for email in emails
+        if email["id"] not in known
+    ]
+    session.add_all(new)
+    return len(new)
+
+
+async def get_undigested_emails(session, mailbox_id):
+    result = await session.scalars(
+        select(EmailSummary)
+        .where(
+            EmailSummary.mailbox_id == mailbox_id,
+            EmailSummary.digested_at.is_(None),
+        )
+        .order_by(EmailSummary.received_at, EmailSummary.message_id)
+    )
+    return result.all()
+
+
+async def delete_digested_emails(session, mailbox_id, before):
+    await session.execute(
+        delete(EmailSummary).where(
+            EmailSummary.mailbox_id == mailbox_id,
+            EmailSummary.digested_at < before,
+        )
+    )
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, func
+from database.models import get_session, SummaryCacheEntry
+from config import SUMMARY_CACHE_MAX_ENTRIES, SUMMARY_CACHE_TTL_DAYS
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+
+class SummaryCache:
+    # Content-addressed cache of LLM summaries. Identical newsletters landing
+    # in different mailboxes hash to the same key, so they are generated once.
+
+    def __init__(
+        self,
+        max_entries=SUMMARY_CACHE_MAX_ENTRIES,
+        ttl=timedelta(days=SUMMARY_CACHE_TTL_DAYS),
+        evict_every=100,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def make_key(self, model, template, text):
+        digest = hashlib.sha256()
+        for part in (model, template, normalize_text(text)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    async def get(self, key):
+        session = get_session()
+        try:
+            entry = await session.get(SummaryCacheEntry, key)
+            if entry is None or entry.created_at < datetime.utcnow() - self.ttl:
+                self.misses += 1
+                return None
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_accessed_at = datetime.utcnow()
+            await session.commit()
+            self.hits += 1
+            self.saved_seconds += entry.generation_seconds or 0
+            return entry.summary
+        finally:
+            await session.close()
+
+    async def set(self, key, summary, model, generation_seconds):
+        session = get_session()
+        try:
+            await session.merge(
+                SummaryCacheEntry(
+                    key=key,
+                    model=model,
+                    summary=summary,
+                    generation_seconds=generation_seconds,
+                    hits=0,
+                    created_at=datetime.utcnow(),
+                    last_accessed_at=datetime.utcnow(),
+                )
+            )
+            await session.commit()
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                await self._evict(session)
+        except Exception as e:
+            await session.rollback()
+            logger.error("Failed to store summary in cache: %s", e)
+        finally:
+            await session.close()
+
+    async def _evict(self, session):
+        # Expired entries first, then least recently used ones over the cap
+        await session.execute(
+            delete(SummaryCacheEntry).where(
+                SummaryCacheEntry.created_at < datetime.utcnow() - self.ttl
+            )
+        )
+        count = await session.scalar(
+            select(func.count()).select_from(SummaryCacheEntry)
+        )
+        overflow = count - self.max_entries
+        if overflow > 0:
+            oldest = (
+                select(SummaryCacheEntry.key)
+                .order_by(SummaryCacheEntry.last_accessed_at)
+                .limit(overflow)
+            )
+            await session.execute(
+                delete(SummaryCacheEntry).where(
+                    SummaryCacheEntry.key.in_(oldest.scalar_subquery())
+                )
+            )
+        await session.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 1),
+        }
@@ -0,0 +1,38 @@
+import calendar
+from datetime import datetime
+from sqlalchemy import select, update
+from database.models import get_session, Mailbox
+
+
+class DatabaseTokenStore:
+    # Persists mail.tm tokens on the Mailbox row so they survive restarts.
+
+    async def load(self, address):
+        session = get_session()
+        try:
+            result = await session.execute(
+                select(Mailbox.token, Mailbox.token_expires_at).where(
+                    Mailbox.email == address
+                )
+            )
+            row = result.first()
+            if not row or not row.token or not row.token_expires_at:
+                return None
+            return row.token, calendar.timegm(row.token_expires_at.timetuple())
+        finally:
+            await session.close()
+
+    async def save(self, address, token, expires_at):
+        session = get_session()
+        try:
+            await session.execute(
+                update(Mailbox)
+                .where(Mailbox.email == address)
+                .values(
+                    token=token,
+                    token_expires_at=datetime.utcfromtimestamp(expires_at),
+                )
+            )
+            await session.commit()
+        finally:
+            await session.close()
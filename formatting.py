@@ -0,0 +1,229 @@
+# formatting.py
+#
+# Turns the Markdown the LLM writes into Telegram MarkdownV2 or HTML. The text
+# is parsed once into a small node tree and then rendered for the requested
+# parse mode. Every scan only moves forward and closing delimiters are looked
+# up with cached str.find calls, so the whole thing is linear in the input.
+import re
+from html import escape as html_escape
+from telegram.constants import ParseMode
+
+MARKER_RE = re.compile(r"[*_`\[]")
+LIST_ITEM_RE = re.compile(r"(?:([*\-+•])|(\d{1,3}[.)]))\s+")
+HEADING_RE = re.compile(r"#{1,6}\s+")
+
+# str.translate tables: one C-level pass per text run
+MARKDOWN_V2_ESCAPES = str.maketrans({c: f"\\{c}" for c in "_*[]()~`>#+-=|{}.!\\"})
+MARKDOWN_V2_CODE_ESCAPES = str.maketrans({c: f"\\{c}" for c in "`\\"})
+MARKDOWN_V2_URL_ESCAPES = str.maketrans({c: f"\\{c}" for c in ")\\"})
+
+# Deeper nesting is rendered as plain text
+MAX_NESTING = 3
+
+
+class _Finder:
+    # str.find with a per-delimiter memo. Lookups within one scan only move
+    # forward, so a cached hit (or miss) stays valid until the scan passes it
+    # and no stretch of text is searched twice for the same delimiter.
+
+    def __init__(self, text, end):
+        self.text = text
+        self.end = end
+        self._found = {}
+
+    def find(self, delimiter, start):
+        found = self._found.get(delimiter)
+        if found is None or -1 < found < start:
+            found = self.text.find(delimiter, start, self.end)
+            self._found[delimiter] = found
+        return found
+
+
+def _is_word_char(char):
+    return char.isalnum()
+
+
+def _parse_entity(text, i, end, finder, depth):
+    # Returns (node, end of entity) or (None, where to resume scanning)
+    char = text[i]
+    if char in "*_" and text.startswith(char, i + 1, end):
+        close = finder.find(char * 2, i + 2)
+        if close > i + 2:
+            return ("bold", _parse_inline(text, i + 2, close, depth + 1)), close + 2
+        return None, i + 2
+
+    if char == "`":
+        close = finder.find("`", i + 1)
+        if close > i + 1:
+            return ("code", text[i + 1 : close]), close + 1
+        return None, i + 1
+
+    if char == "[":
+        close = finder.find("]", i + 1)
+        if close > i + 1 and text.startswith("(", close + 1, end):
+            url_end = finder.find(")", close + 2)
+            url = text[close + 2 : url_end].strip() if url_end != -1 else ""
+            if url:
+                children = _parse_inline(text, i + 1, close, depth + 1)
+                return ("link", children, url), url_end + 1
+        return None, i + 1
+
+    # Single * or _ is italic. The opener must be followed by a non-space and,
+    # for underscores, must not sit inside a word (snake_case stays literal).
+    if i + 1 >= end or text[i + 1].isspace():
+        return None, i + 1
+    if char == "_" and i > 0 and _is_word_char(text[i - 1]):
+        return None, i + 1
+    close = finder.find(char, i + 1)
+    if close == -1 or text[close - 1].isspace():
+        return None, i + 1
+    if char == "_" and close + 1 < end and _is_word_char(text[close + 1]):
+        return None, i + 1
+    return ("italic", _parse_inline(text, i + 1, close, depth + 1)), close + 1
+
+
+def _parse_inline(text, start, end, depth=0):
+    match = MARKER_RE.search(text, start, end)
+    if depth > MAX_NESTING or not match:
+        return [("text", text[start:end])]
+    nodes = []
+    finder = _Finder(text, end)
+    plain_start = i = start
+    while match:
+        node, i = _parse_entity(text, match.start(), end, finder, depth)
+        if node is not None:
+            if plain_start < match.start():
+                nodes.append(("text", text[plain_start : match.start()]))
+            nodes.append(node)
+            plain_start = i
+        match = MARKER_RE.search(text, i, end)
+    if plain_start < end:
+        nodes.append(("text", text[plain_start:end]))
+    return nodes
+
+
+def parse_markdown(text):
+    # Returns a list of paragraphs, each a list of lines:
+    #   ("text", nodes) | ("item", marker, nodes) | ("heading", nodes)
+    # Wrapped lines inside a paragraph are joined with a space; list items
+    # and headings keep their own line.
+    paragraphs = []
+    for paragraph in text.split("\n\n"):
+        lines = []
+        wrapped = []
+
+        def flush():
+            if wrapped:
+                joined = " ".join(wrapped)
+                lines.append(("text", _parse_inline(joined, 0, len(joined))))
+                wrapped.clear()
+
+        for line in paragraph.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            item = LIST_ITEM_RE.match(line)
+            heading = HEADING_RE.match(line)
+            if item:
+                flush()
+                marker = "•" if item.group(1) else item.group(2)
+                body = line[item.end() :]
+                lines.append(("item", marker, _parse_inline(body, 0, len(body))))
+            elif heading:
+                flush()
+                body = line[heading.end() :]
+                lines.append(("heading", _parse_inline(body, 0, len(body))))
+            else:
+                wrapped.append(line)
+        flush()
+        if lines:
+            paragraphs.append(lines)
+    return paragraphs
+
+
+def _escape_markdown_v2(text):
+    return text.translate(MARKDOWN_V2_ESCAPES)
+
+
+def _render_markdown_v2(nodes, out, active=frozenset()):
+    # `active` holds the entities we're inside of. Telegram rejects an entity
+    # nested in one of the same kind, and code inside any other entity, so
+    # those are rendered as their plain contents.
+    for node in nodes:
+        kind = node[0]
+        if kind == "text":
+            out.append(node[1].translate(MARKDOWN_V2_ESCAPES))
+        elif kind == "code":
+            if active:
+                out.append(_escape_markdown_v2(node[1]))
+            else:
+                code = node[1].translate(MARKDOWN_V2_CODE_ESCAPES)
+                out.append(f"`{code}`")
+        elif kind in active or (kind == "italic" and out and out[-1].endswith("_")):
+            # "__" would read as underline, so adjacent italics are merged
+            _render_markdown_v2(node[1], out, active)
+        elif kind == "link":
+            url = node[2].translate(MARKDOWN_V2_URL_ESCAPES)
+            out.append("[")
+            _render_markdown_v2(node[1], out, active | {"link"})
+            out.append(f"]({url})")
+        else:
+            delimiter = "*" if kind == "bold" else "_"
+            out.append(delimiter)
+            _render_markdown_v2(node[1], out, active | {kind})
+            out.append(delimiter)
+
+
+def _render_html(nodes, out, active=frozenset()):
+    for node in nodes:
+        kind = node[0]
+        if kind == "text":
+            out.append(html_escape(node[1], quote=False))
+        elif kind == "code":
+            if active:
+                out.append(html_escape(node[1], quote=False))
+            else:
+                out.append(f"<code>{html_escape(node[1], quote=False)}</code>")
+        elif kind in active:
+            _render_html(node[1], out, active)
+        elif kind == "link":
+            out.append(f'<a href="{html_escape(node[2])}">')
+            _render_html(node[1], out, active | {"link"})
+            out.append("</a>")
+        else:
+            tag = "b" if kind == "bold" else "i"
+            out.append(f"<{tag}>")
+            _render_html(node[1], out, active | {kind})
+            out.append(f"</{tag}>")
+
+
+RENDERERS = {
+    ParseMode.MARKDOWN_V2: (_render_markdown_v2, _escape_markdown_v2, "*", "*"),
+    ParseMode.HTML: (
+        _render_html,
+        lambda t: html_escape(t, quote=False),
+        "<b>",
+        "</b>",
+    ),
+}
+
+
+def format_for_telegram(text, parse_mode=ParseMode.MARKDOWN_V2):
+    render, escape, bold_open, bold_close = RENDERERS[parse_mode]
+    out = []
+    for index, paragraph in enumerate(parse_markdown(text)):
+        if index:
+            out.append("\n\n")
+        for line_index, line in enumerate(paragraph):
+            if line_index:
+                out.append("\n")
+            if line[0] == "item":
+                out.append(f"{escape(line[1])} ")
+                render(line[2], out)
+            elif line[0] == "heading":
+                out.append(bold_open)
+                render(line[1], out, frozenset({"bold"}))
+                out.append(bold_close)
+            else:
+                render(line[1], out)
+    return "".join(out)
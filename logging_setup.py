@@ -0,0 +1,96 @@
+# logging_setup.py
+#
+# Logging is configured once, by the entry point (main.py), through
+# configure_logging(). Modules only create their logger and log with lazy
+# %-style arguments, so a message below the active level is never formatted.
+#
+# Per-message events (one line per email, chunk or API call) are logged with
+# extra=SAMPLED and only one in LOG_SAMPLE_RATE of them is written, counted
+# per message template. Every written message is cut to LOG_MAX_CHARS so a
+# stray payload can't flood the log.
+import json
+import logging
+from datetime import datetime, timezone
+from config import LOG_LEVEL, LOG_FORMAT, LOG_MAX_CHARS, LOG_SAMPLE_RATE
+
+SAMPLED = {"sampled": True}
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Third-party loggers that are chatty at INFO (httpx logs every getUpdates)
+QUIET_LOGGERS = ("httpx", "httpcore", "apscheduler", "aiosqlite")
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
+
+def _truncate(text, limit):
+    if limit and len(text) > limit:
+        return f"{text[:limit]}… [{len(text) - limit} more chars]"
+    return text
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps one in `rate` records marked `sampled`, per message template, and
+    # tags the kept ones with the rate so totals can be scaled back up.
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._seen = {}
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False) or self.rate == 1:
+            return True
+        key = (record.name, record.msg)
+        seen = self._seen.get(key, 0)
+        self._seen[key] = seen + 1
+        if seen % self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, max_chars=LOG_MAX_CHARS):
+        super().__init__(TEXT_FORMAT)
+        self.max_chars = max_chars
+
+    def formatMessage(self, record):
+        record.message = _truncate(record.message, self.max_chars)
+        return super().formatMessage(record)
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; `extra` fields become top-level keys
+
+    def __init__(self, max_chars=LOG_MAX_CHARS):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": _truncate(record.getMessage(), self.max_chars),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != "sampled":
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    handler.addFilter(SamplingFilter())
+    logging.basicConfig(level=level.upper(), handlers=[handler], force=True)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(
+            max(logging.WARNING, logging.getLogger().level)
+        )
@@ -1,22 +1,42 @@
 # main.py
 import asyncio
 import logging
+import signal
 from telegram.ext import Application, CommandHandler
-from config import TELEGRAM_BOT_TOKEN
-from database.models import get_session, User
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    MAIL_TM_TOKEN_PERSIST,
+    SUMMARY_CACHE_ENABLED,
+    SCHEDULER_SWEEP_INTERVAL,
+    OLLAMA_WARM_UP,
+    TELEGRAM_MODE,
+    TELEGRAM_CONCURRENT_UPDATES,
+)
+from database.models import get_session, async_engine
+from database.migrations import check_schema_version
+from database.leases import mailbox_leases
 from bot.commands import (
     create_mailbox,
     list_mailboxes,
+    set_model,
     set_frequency_handler,
     trigger_summary_handler,
 )
-from sqlalchemy import text
-from tasks import process_user_mailboxes
-
-# Set up logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+from tasks import sweep_due_mailboxes, mailbox_pool
+from api_clients.mail_tm import mail_tm_client
+from api_clients.token_cache import token_cache
+from database.token_store import DatabaseTokenStore
+from database.summary_cache import SummaryCache
+from api_clients.ollama import ollama_client
+from bot.delivery import delivery_queue
+from bot.webhook import run_webhook
+from bot.update_processor import PerChatUpdateProcessor
+from cpu_pool import cpu_pool, loop_monitor
+from metrics import metrics_server
+from logging_setup import configure_logging
+
+# The only place logging is configured; see logging_setup.py
+configure_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -34,57 +54,119 @@ async def help_command(update, context):
     /create_mailbox <tag> - Create a new mailbox with the given tag
     /list_mailboxes - List your active mailboxes (up to 3)
     /set_frequency - Set summary frequency for a mailbox
+    /set_model <tag> [model] - Choose the LLM model for a mailbox's summaries
     /trigger_summary - Trigger immediate summary generation for all mailboxes
     """
     await update.message.reply_text(help_text)
 
 
-def init_db():
+async def init_db():
     session = get_session()
     try:
-        # Check if we can connect to the database
-        session.execute(text("SELECT 1"))
-        logger.info("Database initialized successfully")
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+        version = await check_schema_version(session)
+        logger.info("Database initialized successfully (schema version %s)", version)
     finally:
-        session.close()
+        await session.close()
+
+
+async def post_init(application):
+    loop_monitor.start()
+    cpu_pool.start()
+    await metrics_server.start()
+    await init_db()
+    await mail_tm_client.start()
+    if MAIL_TM_TOKEN_PERSIST:
+        token_cache.store = DatabaseTokenStore()
+    if SUMMARY_CACHE_ENABLED:
+        ollama_client.cache = SummaryCache()
+    await ollama_client.start()
+    if OLLAMA_WARM_UP:
+        ollama_client.start_warm_up()
+    mailbox_leases.start()
+    mailbox_pool.start()
+    delivery_queue.start()
+
+
+async def post_shutdown(application):
+    await mailbox_pool.stop()
+    await delivery_queue.stop()
+    await mailbox_leases.stop()
+    logger.info("Mailbox leases at shutdown: %s", mailbox_leases.stats())
+    await async_engine.dispose()
+    logger.info("mail.tm connection pool at shutdown: %s", mail_tm_client.pool_stats())
+    logger.info("mail.tm token cache at shutdown: %s", token_cache.stats())
+    if ollama_client.cache:
+        logger.info("Summary cache at shutdown: %s", ollama_client.cache.stats())
+    logger.info("Telegram delivery at shutdown: %s", delivery_queue.stats())
+    logger.info("LLM backends at shutdown: %s", ollama_client.backend.stats())
+    await loop_monitor.stop()
+    logger.info("CPU pool at shutdown: %s", cpu_pool.stats())
+    logger.info("Event loop lag at shutdown: %s", loop_monitor.stats())
+    cpu_pool.close()
+    await metrics_server.stop()
+    await ollama_client.close()
+    await mail_tm_client.close()
+
+
+async def run_worker(application):
+    # Worker mode: no updates are received, only the due-mailbox sweeper runs.
+    # Start any number of these next to one polling or webhook instance; the
+    # lease rows make sure each mailbox is processed by one of them.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        logger.info("Worker %s started", mailbox_leases.owner)
+        await stop.wait()
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 
 def main():
     logger.info("Starting the bot")
 
-    init_db()
-
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(TELEGRAM_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("create_mailbox", create_mailbox))
     application.add_handler(CommandHandler("list_mailboxes", list_mailboxes))
+    application.add_handler(CommandHandler("set_model", set_model))
     application.add_handler(trigger_summary_handler)
     application.add_handler(set_frequency_handler)
 
-    # Schedule jobs for all existing users
-    session = get_session()
-    try:
-        users = session.query(User).all()
-        for user in users:
-            next_run = min(
-                (mb.next_summary_time for mb in user.mailboxes), default=None
-            )
-            if next_run:
-                application.job_queue.run_once(
-                    process_user_mailboxes,
-                    when=next_run,
-                    data={"user_id": user.id},
-                    name=f"user_{user.id}_summary",
-                )
-    finally:
-        session.close()
+    # One recurring job dispatches every due mailbox; see sweep_due_mailboxes
+    application.job_queue.run_repeating(
+        sweep_due_mailboxes,
+        interval=SCHEDULER_SWEEP_INTERVAL,
+        first=1,
+        name="due_mailbox_sweeper",
+    )
 
-    logger.info("Bot is ready to accept commands")
-    application.run_polling()
+    logger.info("Bot is ready to accept commands (%s mode)", TELEGRAM_MODE)
+    if TELEGRAM_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    elif TELEGRAM_MODE == "worker":
+        asyncio.run(run_worker(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+# metrics.py
+#
+# Counters, gauges and histograms rendered in the Prometheus text format and
+# served on a local /metrics endpoint. Deliberately tiny: no dependency, no
+# locking (everything that records runs on the event loop thread), and label
+# values are passed as keyword arguments.
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from aiohttp import web
+from config import METRICS_LISTEN, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 1800, 3600, 7200)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), registry=None, callback=None):
+        # `callback()` is called at scrape time and returns the value, or a
+        # {label values tuple: value} dict for labelled metrics. It exposes
+        # counters an object already keeps without recording them twice.
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        if self.callback is not None:
+            value = self.callback()
+            self._values = value if isinstance(value, dict) else {(): value}
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, **kwargs
+    ):
+        super().__init__(name, documentation, labels, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # [per-bucket counts (last one is +Inf), sum, count]
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        # Observes the duration of the block; `labels` may be updated inside
+        # it (e.g. with the outcome) before it is recorded.
+        started = time.monotonic()
+        try:
+            yield labels
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    self.labels, key, f'le="{_format_value(float(bound))}"'
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error("Failed to collect metric %s: %s", metric.name, e)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+# mail.tm
+MAIL_TM_REQUEST_SECONDS = Histogram(
+    "mail_tm_request_seconds",
+    "mail.tm API request latency.",
+    ("method", "endpoint", "status"),
+)
+
+# LLM backends
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    "llm_queue_wait_seconds",
+    "Time a generation waited for a free backend slot.",
+    buckets=SLOW_BUCKETS,
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_seconds",
+    "LLM generation latency.",
+    ("backend", "model", "outcome"),
+    buckets=SLOW_BUCKETS,
+)
+LLM_TOKENS = Histogram(
+    "llm_tokens_per_call",
+    "Prompt and completion tokens per LLM generation.",
+    ("backend", "kind"),
+    buckets=TOKEN_BUCKETS,
+)
+LLM_WARM_UP_SECONDS = Histogram(
+    "llm_warm_up_seconds",
+    "Model preload time per host; kind is cold (model was loaded) or warm.",
+    ("backend", "kind"),
+    buckets=SLOW_BUCKETS,
+)
+SUMMARY_CACHE_LOOKUPS = Counter(
+    "summary_cache_lookups_total",
+    "Summary cache lookups by result.",
+    ("result",),
+)
+SUMMARY_CHUNKS = Histogram(
+    "summary_chunks",
+    "Chunks summarized per email (kind=email) or digest (kind=digest).",
+    ("kind",),
+    buckets=COUNT_BUCKETS,
+)
+
+# Database
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds",
+    "Database statement execution time.",
+    ("statement",),
+)
+
+# Telegram
+TELEGRAM_SEND_SECONDS = Histogram(
+    "telegram_send_seconds",
+    "Telegram sendMessage latency.",
+    ("outcome",),
+)
+
+# Scheduling
+SCHEDULER_LAG_SECONDS = Histogram(
+    "scheduler_lag_seconds",
+    "How long after next_summary_time a due mailbox started processing.",
+    buckets=LAG_BUCKETS,
+)
+MAILBOX_PROCESSING_SECONDS = Histogram(
+    "mailbox_processing_seconds",
+    "Time to fetch, summarize and deliver one mailbox.",
+    ("outcome",),
+    buckets=SLOW_BUCKETS,
+)
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke up a periodic sleep.",
+)
+
+
+async def metrics_handler(request):
+    return web.Response(
+        text=REGISTRY.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+class MetricsServer:
+    # Local scrape endpoint, separate from the (public) webhook server
+
+    def __init__(self, host=METRICS_LISTEN, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if self._runner is not None or not self.port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            # e.g. a second worker on the same host without its own port
+            logger.error("Metrics server could not listen on port %s: %s", self.port, e)
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info("Metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
@@ -0,0 +1,180 @@
+# preprocessing.py
+import re
+from html import unescape
+from html.parser import HTMLParser
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, unquote
+
+SKIP_TAGS = {"script", "style", "head", "title", "noscript", "template", "svg"}
+BLOCK_TAGS = {
+    "p", "div", "br", "tr", "table", "li", "ul", "ol", "section", "article",
+    "header", "footer", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "hr",
+}  # fmt: skip
+
+# Query parameters that link-tracking services use to carry the real target
+REDIRECT_PARAMS = ("url", "u", "redirect", "redirect_url", "target", "link", "r", "q")
+TRACKING_PARAM_RE = re.compile(r"^(utm_\w+|mc_cid|mc_eid|fbclid|gclid|ref_src)$")
+URL_RE = re.compile(r"https?://[^\s<>\"')\]]+")
+
+BOILERPLATE_RE = re.compile(
+    r"unsubscribe|view (this email )?in (your )?browser|manage (your )?(preferences|subscription)"
+    r"|update your preferences|you (are )?received this|you're receiving this"
+    r"|you are receiving this|no longer wish to receive|all rights reserved|©|&copy;",
+    re.IGNORECASE,
+)
+# Only short paragraphs are treated as boilerplate so a real article that
+# happens to mention "unsubscribe" is kept.
+BOILERPLATE_MAX_CHARS = 300
+
+INLINE_SPACE_RE = re.compile(r"[ \t\r\f\v\xa0\u200b\u200c\u200d\ufeff]+")
+BLANK_LINES_RE = re.compile(r"\n\s*\n+")
+HTML_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def unwrap_url(url, max_depth=3):
+    # Follows redirect wrappers like https://click.example.com/?url=<target>
+    # and drops analytics parameters from the final URL.
+    for _ in range(max_depth):
+        parts = urlsplit(url)
+        params = dict(parse_qsl(parts.query, keep_blank_values=True))
+        target = next(
+            (
+                unquote(params[name])
+                for name in REDIRECT_PARAMS
+                if params.get(name, "").startswith(("http://", "https://"))
+            ),
+            None,
+        )
+        if not target:
+            break
+        url = target
+    parts = urlsplit(url)
+    params = parse_qsl(parts.query, keep_blank_values=True)
+    query = [(key, value) for key, value in params if not TRACKING_PARAM_RE.match(key)]
+    if len(query) == len(params):
+        # Nothing to drop: keep the query as written (urlencode would turn
+        # `?flag` into `?flag=` and re-quote values)
+        return url
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+        self._href = None
+        self._link_text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self._flush_link()
+            self.parts.append("\n\n" if tag not in ("br", "li", "tr") else "\n")
+        elif tag == "a":
+            self._flush_link()
+            self._href = dict(attrs).get("href")
+            self._link_text = []
+
+    def handle_startendtag(self, tag, attrs):
+        # <img> is dropped entirely: tracking pixels and decorative images
+        if tag in BLOCK_TAGS:
+            self._flush_link()
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self._flush_link()
+            self.parts.append("\n")
+        elif tag == "a":
+            self._flush_link()
+
+    def _flush_link(self):
+        # Writes out the pending link. Also called when a block starts or
+        # ends and at the end of input, so an <a> that is never closed
+        # doesn't swallow the rest of the email.
+        if self._href is None:
+            return
+        text = "".join(self._link_text).strip()
+        href = self._href
+        self._href = None
+        self._link_text = []
+        if not text:
+            return
+        if href.startswith(("http://", "https://")):
+            url = unwrap_url(href)
+            if url != text:
+                text = f"{text} ({url})"
+        self.parts.append(text)
+
+    def close(self):
+        super().close()
+        self._flush_link()
+
+    def handle_data(self, data):
+        if self._skip_depth:
+            return
+        # Line breaks in HTML source are insignificant; block tags add ours
+        data = HTML_WHITESPACE_RE.sub(" ", data)
+        if self._href is not None:
+            self._link_text.append(data)
+        else:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.parts)
+
+
+def clean_text(text):
+    text = URL_RE.sub(lambda m: unwrap_url(m.group(0)), text)
+    paragraphs = []
+    for paragraph in BLANK_LINES_RE.split(text):
+        lines = [
+            INLINE_SPACE_RE.sub(" ", line).strip() for line in paragraph.split("\n")
+        ]
+        paragraph = "\n".join(line for line in lines if line)
+        if not paragraph:
+            continue
+        if len(paragraph) <= BOILERPLATE_MAX_CHARS and BOILERPLATE_RE.search(paragraph):
+            continue
+        paragraphs.append(paragraph)
+    return "\n\n".join(paragraphs)
+
+
+def message_size(message):
+    # Characters of text and HTML in a mail.tm message, before any cleanup
+    html = message.get("html") or ""
+    if isinstance(html, list):
+        return len(message.get("text") or "") + sum(len(part) for part in html)
+    return len(message.get("text") or "") + len(html)
+
+
+def extract_message_text(message):
+    # Returns (text, stats) for a mail.tm message. mail.tm sends `html` as a
+    # list of strings; the plain `text` part is preferred when present.
+    text = message.get("text") or ""
+    html = message.get("html") or ""
+    if isinstance(html, list):
+        html = "".join(html)
+
+    if text.strip():
+        raw = text
+        # Plain-text parts may still carry entities; html_to_text already
+        # decodes them, so unescaping its output again would turn a literal
+        # "&lt;" into "<"
+        cleaned = clean_text(unescape(text))
+    else:
+        raw = html
+        cleaned = clean_text(html_to_text(html)) if html else ""
+
+    stats = {
+        "input_bytes": len(raw.encode("utf-8")),
+        "output_bytes": len(cleaned.encode("utf-8")),
+    }
+    return cleaned, stats
@@ -0,0 +1,143 @@
+# scheduler.py
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from config import SCHEDULER_WORKERS, SCHEDULER_PER_USER_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+
+class MailboxWorkerPool:
+    # Processes mailboxes from all users on a fixed number of workers.
+    # Users are served round-robin and each user has at most
+    # `per_user_concurrency` mailboxes in flight, so one user with many (or
+    # huge) mailboxes can't starve everyone else.
+
+    def __init__(
+        self,
+        handler,
+        workers=SCHEDULER_WORKERS,
+        per_user_concurrency=SCHEDULER_PER_USER_CONCURRENCY,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.per_user_concurrency = per_user_concurrency
+        self._queues = OrderedDict()  # user key -> deque of pending jobs
+        self._active = {}  # user key -> mailboxes currently processing
+        self._pending = {}  # mailbox_id -> future, to drop duplicate submits
+        self._condition = None
+        self._tasks = []
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._condition = asyncio.Condition()
+        self._tasks = [
+            asyncio.create_task(self._worker(i)) for i in range(max(1, self.workers))
+        ]
+        logger.info("Mailbox worker pool started with %s workers", len(self._tasks))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for future in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+        self._queues.clear()
+        self._active.clear()
+
+    async def submit(self, bot, chat_id, mailbox_id, urgent=False):
+        # Returns a future resolved when the mailbox has been processed.
+        # Submitting a mailbox that is already queued or running joins it.
+        # `urgent` jobs (manual triggers) go to the front of the queue, and
+        # their user to the front of the round-robin, instead of waiting
+        # behind everything the sweeper queued.
+        self.start()
+        key = str(chat_id)
+        if mailbox_id in self._pending:
+            if urgent:
+                async with self._condition:
+                    self._promote(key, mailbox_id)
+            return self._pending[mailbox_id]
+        future = asyncio.get_running_loop().create_future()
+        self._pending[mailbox_id] = future
+        job = (bot, chat_id, mailbox_id)
+        async with self._condition:
+            queue = self._queues.setdefault(key, deque())
+            if urgent:
+                queue.appendleft(job)
+                self._queues.move_to_end(key, last=False)
+            else:
+                queue.append(job)
+            self._condition.notify()
+        return future
+
+    def _promote(self, key, mailbox_id):
+        queue = self._queues.get(key)
+        if not queue:
+            return  # already running
+        for job in queue:
+            if job[2] == mailbox_id:
+                queue.remove(job)
+                queue.appendleft(job)
+                self._queues.move_to_end(key, last=False)
+                return
+
+    async def run_all(self, bot, chat_id, mailbox_ids):
+        futures = [await self.submit(bot, chat_id, mid) for mid in mailbox_ids]
+        await asyncio.gather(*futures, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "queued": sum(len(queue) for queue in self._queues.values()),
+            "in_flight": sum(self._active.values()),
+            "users_waiting": len(self._queues),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    def _next_job(self):
+        for key, queue in self._queues.items():
+            if self._active.get(key, 0) < self.per_user_concurrency:
+                job = queue.popleft()
+                # Rotate this user to the back so the next pick is someone else
+                del self._queues[key]
+                if queue:
+                    self._queues[key] = queue
+                self._active[key] = self._active.get(key, 0) + 1
+                return key, job
+        return None
+
+    async def _worker(self, index):
+        while True:
+            async with self._condition:
+                picked = self._next_job()
+                while picked is None:
+                    await self._condition.wait()
+                    picked = self._next_job()
+            key, (bot, chat_id, mailbox_id) = picked
+            future = self._pending.get(mailbox_id)
+            try:
+                await self.handler(bot, chat_id, mailbox_id)
+                self.processed += 1
+                if future and not future.done():
+                    future.set_result(True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error("Worker %s failed on mailbox %s: %s", index, mailbox_id, e)
+                if future and not future.done():
+                    future.set_result(False)
+            finally:
+                self._pending.pop(mailbox_id, None)
+                async with self._condition:
+                    self._active[key] -= 1
+                    if not self._active[key]:
+                        del self._active[key]
+                    self._condition.notify_all()
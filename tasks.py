@@ -1,128 +1,260 @@
 # tasks.py
+import asyncio
 import logging
+import time
+from functools import partial
 from database.models import get_session, Mailbox, User
-from api_clients.mail_tm import mail_tm_client
+from database.leases import mailbox_leases
+from database.repository import (
+    get_mailbox_with_owner,
+    add_pending_emails,
+    get_undigested_emails,
+    delete_digested_emails,
+)
+from api_clients.mail_tm import mail_tm_client, parse_timestamp, MailTMUnauthorized
+from api_clients.token_cache import token_cache
+from preprocessing import extract_message_text, message_size
+from cpu_pool import cpu_pool
+from logging_setup import SAMPLED
+from metrics import SCHEDULER_LAG_SECONDS, MAILBOX_PROCESSING_SECONDS, Gauge
+from scheduler import MailboxWorkerPool
+from bot.progress import ProgressiveMessage
+from bot.delivery import delivery_queue
+from formatting import format_for_telegram
+from config import (
+    SCHEDULER_SWEEP_INTERVAL,
+    SCHEDULER_SWEEP_BATCH,
+    SCHEDULER_MAX_QUEUED,
+    SCHEDULER_CLAIM_LIMIT,
+    OLLAMA_STREAM,
+    OLLAMA_WARM_UP,
+    TELEGRAM_PARSE_MODE,
+    EMAIL_SUMMARY_RETENTION_DAYS,
+)
 from api_clients.ollama import ollama_client
-from telegram.constants import ParseMode
-import re
-
-
-def format_for_telegram(text):
-    # Escape special characters
-    special_chars = "_*[]()~`>#+-=|{}.!"
-    for char in special_chars:
-        text = text.replace(char, f"\\{char}")
-
-    # Replace markdown formatting with Telegram-compatible formatting
-    text = re.sub(r"\\\*\\\*(.*?)\\\*\\\*", r"*\1*", text)  # Bold
-    text = re.sub(r"\\\_(.*?)\\\_", r"_\1_", text)  # Italic
-    text = text.replace("\\•", "•")  # Bullet points
-
-    # Unescape periods within URLs
-    text = re.sub(
-        r"(\[.*?\]\()(.*?)(\\\.)(.*?)(\))",
-        lambda m: f"{m.group(1)}{m.group(2)}.{m.group(4)}{m.group(5)}",
-        text,
-    )
-
-    # Ensure proper line breaks
-    paragraphs = text.split("\n\n")
-    formatted_paragraphs = [p.replace("\n", " ").strip() for p in paragraphs]
-
-    return "\n\n".join(formatted_paragraphs)
-
+from datetime import datetime, timedelta
+from sqlalchemy import select, tuple_
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
 
 async def fetch_emails_for_mailbox(mailbox):
-    logger.info(f"Fetching unread emails for mailbox: {mailbox.email}")
-    token = await mail_tm_client.get_token(mailbox.email, mailbox.password)
+    logger.info("Fetching unread emails for mailbox: %s", mailbox.email)
+    token = await token_cache.get(mailbox.email, mailbox.password)
     if not token:
-        logger.error(f"Failed to authenticate mailbox: {mailbox.email}")
+        logger.error("Failed to authenticate mailbox: %s", mailbox.email)
         return []
 
-    unread_messages = await mail_tm_client.fetch_unread_messages(token)
-    logger.info(f"Fetched {len(unread_messages)} unread messages for {mailbox.email}")
-
     processed_messages = []
-    for message in unread_messages:
-        logger.debug(f"Processing unread message: {message}")
-
-        content = message.get("text", message.get("html", ""))
-        if not content:
-            content = "No readable content found in this email."
-
-        processed_messages.append(
-            {
-                "id": message.get("id"),
-                "subject": message.get("subject", "No Subject"),
-                "body": content,
-            }
+    processed_ids = set()
+    newest_message_at = mailbox.last_message_at
+    input_bytes = output_bytes = 0
+    fetch_failures = []
+
+    async def consume(token):
+        nonlocal newest_message_at, input_bytes, output_bytes
+        # Stream messages page by page; only the trimmed fields below are kept,
+        # the full mail.tm payload is dropped as soon as it has been processed.
+        # Already processed ids are skipped so a retry after a 401 is safe.
+        fetch_failures.clear()
+        async for message in mail_tm_client.iter_unread_messages(
+            token, since=mailbox.last_message_at, failures=fetch_failures
+        ):
+            if message.get("id") in processed_ids:
+                continue
+            processed_ids.add(message.get("id"))
+            logger.debug(
+                "Processing unread message %s (%r, %s chars)",
+                message.get("id"),
+                message.get("subject"),
+                message_size(message),
+                extra=SAMPLED,
+            )
+
+            created_at = parse_timestamp(message.get("createdAt"))
+            if newest_message_at is None or created_at > newest_message_at:
+                newest_message_at = created_at
+
+            content, stats = await cpu_pool.run(
+                extract_message_text, message, size=message_size(message)
+            )
+            input_bytes += stats["input_bytes"]
+            output_bytes += stats["output_bytes"]
+            logger.debug(
+                "Cleaned message %s: %s -> %s bytes",
+                message.get("id"),
+                stats["input_bytes"],
+                stats["output_bytes"],
+                extra=SAMPLED,
+            )
+            if not content:
+                content = "No readable content found in this email."
+
+            processed_messages.append(
+                {
+                    "id": message.get("id"),
+                    "subject": message.get("subject", "No Subject"),
+                    "body": content,
+                    "created_at": created_at,
+                }
+            )
+
+    await token_cache.call(mailbox.email, mailbox.password, consume)
+
+    # Messages that failed to fetch are still unread; keep the cursor before
+    # the oldest of them so the next run lists them again. A page that failed
+    # to list hides everything older, so then the cursor stays where it was.
+    if fetch_failures:
+        logger.warning(
+            "Failed to fetch %s unread messages for %s; will retry next run",
+            len(fetch_failures),
+            mailbox.email,
         )
-        # Mark the message as read
-        await mail_tm_client.mark_message_as_read(token, message["id"])
+        failed_at = [created_at for _, created_at, _ in fetch_failures]
+        if None in failed_at:
+            newest_message_at = mailbox.last_message_at
+        else:
+            retry_from = min(failed_at) - timedelta(microseconds=1)
+            if newest_message_at is not None and newest_message_at > retry_from:
+                newest_message_at = retry_from
+    mailbox.last_message_at = newest_message_at
 
     logger.info(
-        f"Processed {len(processed_messages)} unread messages for {mailbox.email}"
+        "Processed %s unread messages for %s (content %s -> %s bytes after cleanup)",
+        len(processed_messages),
+        mailbox.email,
+        input_bytes,
+        output_bytes,
     )
     return processed_messages
 
 
-async def summarize_emails(emails):
-    print("Entering summarize_emails function")
-    if not emails or not isinstance(emails, list):
-        logger.info("No new emails to summarize.")
-        return "No new emails to summarize."
+async def mark_emails_as_read(mailbox, message_ids):
+    # Only called once the emails and the advanced cursor are committed: a
+    # message marked as read is never listed again, so marking it any
+    # earlier would lose it if the commit failed or the process died.
+    if not message_ids:
+        return
+    pending_ids = list(message_ids)
+    failures = []
+
+    async def mark(token):
+        nonlocal pending_ids, failures
+        failures = await mail_tm_client.mark_messages_as_read(token, pending_ids)
+        if any(isinstance(error, MailTMUnauthorized) for _, error in failures):
+            pending_ids = [message_id for message_id, _ in failures]
+            raise MailTMUnauthorized(f"mark as read for {mailbox.email}")
+
+    try:
+        await token_cache.call(mailbox.email, mailbox.password, mark)
+    except Exception as e:
+        # The emails are stored and the cursor is past them, so they won't
+        # be fetched again; they just stay unread on mail.tm
+        logger.error("Failed to mark messages as read for %s: %s", mailbox.email, e)
+        return
+    if failures:
+        logger.warning(
+            "Failed to mark %s messages as read for %s", len(failures), mailbox.email
+        )
+
 
-    print(f"Number of emails to summarize: {len(emails)}")
+async def summarize_pending_emails(session, entries, model=None):
+    # Summarizes stored emails that don't have a summary yet. Each summary is
+    # committed as soon as it's ready, so a failure later on loses nothing and
+    # an email that failed is simply retried on the next run.
+    slots = asyncio.Semaphore(max(1, ollama_client.concurrency))
 
-    all_text = ""
-    for email in emails:
-        subject = email.get("subject", "No Subject")
-        body = email.get("body", "No Content")
-        all_text += f"Subject: {subject}\n\nContent:\n{body}\n\n---\n\n"
+    async def summarize(entry):
+        async with slots:
+            try:
+                summary = await ollama_client.summarize_document(
+                    f"Subject: {entry.subject}\n\n{entry.body}", model
+                )
+            except Exception as e:
+                logger.error("Failed to summarize email %s: %s", entry.message_id, e)
+                summary = None
+        return entry, summary
+
+    summarized = 0
+    for next_done in asyncio.as_completed([summarize(e) for e in entries]):
+        entry, summary = await next_done
+        if summary:
+            entry.summary = summary
+            entry.model = model or ollama_client.model
+            entry.body = None
+            await session.commit()
+            summarized += 1
+    return summarized
+
+
+async def summarize_emails(entries, on_progress=None, model=None):
+    # Reduces stored per-email summaries (EmailSummary rows) into one digest.
+    # Returns (text, complete); on failure the text lists the subjects and
+    # the entries should stay undigested.
+    if not entries:
+        logger.info("No new emails to summarize.")
+        return "No new emails to summarize.", False
+
+    digest_text = "\n\n---\n\n".join(
+        f"Subject: {entry.subject}\n\n{entry.summary}" for entry in entries
+    )
+    subjects = "\n".join(f"- {entry.subject or 'No Subject'}" for entry in entries)
 
     try:
-        print("About to call ollama_client.summarize_text")
-        summary = await ollama_client.summarize_text(all_text)
-        print(
-            f"Received summary from Ollama (first 100 chars): {summary[:100] if summary else 'No summary generated'}..."
+        logger.debug("Summarizing a digest of %s emails", len(entries))
+
+        async def report(partial):
+            await on_progress(f"Summary of {len(entries)} emails:\n\n{partial}")
+
+        summary = await ollama_client.summarize_text(
+            digest_text, report if on_progress else None, model
+        )
+        logger.debug(
+            "Received digest summary: %.100s...", summary or "No summary generated"
         )
 
         if summary:
-            return f"Summary of {len(emails)} emails:\n\n{summary}"
+            return f"Summary of {len(entries)} emails:\n\n{summary}", True
         else:
             return (
-                f"Failed to generate summary. Here are the subjects of the {len(emails)} new emails:\n\n"
-                + "\n".join(
-                    [f"- {email.get('subject', 'No Subject')}" for email in emails]
-                )
-            )
+                f"Failed to generate summary. Here are the subjects of the {len(entries)} new emails:\n\n"
+                + subjects
+            ), False
     except Exception as e:
-        logger.error(f"Error in summarizing emails: {str(e)}")
+        logger.error("Error in summarizing emails: %s", e)
         return (
-            f"Error in summarizing emails. Here are the subjects of the {len(emails)} new emails:\n\n"
-            + "\n".join([f"- {email.get('subject', 'No Subject')}" for email in emails])
-        )
-
-
-async def process_mailbox(mailbox):
-    emails = await fetch_emails_for_mailbox(mailbox)
-    if emails:
-        summary = await summarize_emails(emails)
-        # Here you would typically store this summary or send it to the user
-        logger.info(f"Summary for {mailbox.email}: {summary}")
+            f"Error in summarizing emails. Here are the subjects of the {len(entries)} new emails:\n\n"
+            + subjects
+        ), False
 
 
 async def process_single_mailbox(bot, chat_id, mailbox_id):
-    logger.info(f"Processing mailbox_id: {mailbox_id} for chat_id: {chat_id}")
+    logger.info("Processing mailbox_id: %s for chat_id: %s", mailbox_id, chat_id)
+    # Already ours when the sweeper dispatched it; a manual trigger takes the
+    # lease here unless this or another worker is on this mailbox right now.
+    # Manual triggers go through mailbox_pool.submit, which joins a run that
+    # is already queued or in progress here.
+    if not await mailbox_leases.claim(mailbox_id):
+        logger.info("Mailbox %s is being processed by another worker", mailbox_id)
+        await bot.send_message(
+            chat_id=chat_id,
+            text="This mailbox is already being processed, its summary is on the way.",
+        )
+        return
+    started = time.monotonic()
+    outcome = "error"
     session = get_session()
     try:
-        mailbox = session.query(Mailbox).get(mailbox_id)
+        mailbox = await get_mailbox_with_owner(session, mailbox_id)
+        # End the read transaction so no connection is held while talking to
+        # mail.tm and Ollama; the mailbox stays attached for the final update.
+        await session.commit()
+        if mailbox and mailbox.next_summary_time:
+            lag = (datetime.utcnow() - mailbox.next_summary_time).total_seconds()
+            if lag >= 0:
+                SCHEDULER_LAG_SECONDS.observe(lag)
         if not mailbox or str(mailbox.user.chat_id) != str(chat_id):
-            logger.error(f"Mailbox not found or doesn't belong to user: {mailbox_id}")
+            logger.error("Mailbox not found or doesn't belong to user: %s", mailbox_id)
             await bot.send_message(
                 chat_id=chat_id,
                 text="Mailbox not found or doesn't belong to you.",
@@ -134,15 +266,59 @@ async def process_single_mailbox(bot, chat_id, mailbox_id):
             text=f"Processing mailbox: {mailbox.email}",
         )
 
-        unread_emails = await fetch_emails_for_mailbox(mailbox)
-        if unread_emails:
-            await bot.send_message(
+        async with mail_tm_client.mailbox_slots:
+            unread_emails = await fetch_emails_for_mailbox(mailbox)
+        # Store the fetched emails together with the advanced message cursor;
+        # from here on they survive a failed or interrupted digest.
+        await add_pending_emails(session, mailbox.id, unread_emails)
+        await session.commit()
+        await mark_emails_as_read(mailbox, [email["id"] for email in unread_emails])
+        entries = await get_undigested_emails(session, mailbox.id)
+        await session.commit()
+
+        if entries:
+            model = ollama_client.model_for(mailbox.model)
+            status = await bot.send_message(
                 chat_id=chat_id,
-                text=f"Found {len(unread_emails)} new emails in {mailbox.email}. Generating summary...",
+                text=f"Found {len(entries)} new emails in {mailbox.email}. Generating summary...",
             )
-            summary = await summarize_emails(unread_emails)
-            if summary:
-                await send_summary(bot, chat_id, summary)
+            pending = [entry for entry in entries if entry.summary is None]
+            if pending:
+                await summarize_pending_emails(session, pending, model)
+            ready = [entry for entry in entries if entry.summary]
+            if ready:
+                # Stream the digest into the status message as it's generated
+                progress = None
+                if OLLAMA_STREAM and status is not None:
+                    progress = ProgressiveMessage(bot, chat_id, status.message_id)
+                summary, complete = await summarize_emails(
+                    ready, progress.update if progress else None, model
+                )
+                if len(ready) < len(entries):
+                    summary += (
+                        f"\n\n{len(entries) - len(ready)} more emails couldn't be "
+                        "summarized yet and will be included next time."
+                    )
+                delivered = False
+                if progress is not None:
+                    formatted = await cpu_pool.run(
+                        format_for_telegram,
+                        summary,
+                        TELEGRAM_PARSE_MODE,
+                        size=len(summary),
+                    )
+                    delivered = await progress.finish(formatted, TELEGRAM_PARSE_MODE)
+                if not delivered:
+                    delivered = await send_summary(bot, chat_id, summary)
+                if complete and delivered:
+                    now = datetime.utcnow()
+                    for entry in ready:
+                        entry.digested_at = now
+                    await delete_digested_emails(
+                        session,
+                        mailbox.id,
+                        now - timedelta(days=EMAIL_SUMMARY_RETENTION_DAYS),
+                    )
             else:
                 await bot.send_message(
                     chat_id=chat_id,
@@ -155,54 +331,122 @@ async def process_single_mailbox(bot, chat_id, mailbox_id):
             )
 
         mailbox.calculate_next_summary_time()
-        session.commit()
+        await session.commit()
+        outcome = "ok"
 
     except Exception as e:
-        logger.error(f"Error processing mailbox {mailbox_id}: {str(e)}")
+        logger.error("Error processing mailbox %s: %s", mailbox_id, e)
         await bot.send_message(
             chat_id=chat_id,
             text=f"An error occurred while processing mailbox {mailbox.email}. Please try again later.",
         )
     finally:
-        session.close()
-
-
-async def process_user_mailboxes(context):
-    user_id = context.job.data["user_id"]
-    logger.info(f"Processing mailboxes for user_id: {user_id}")
+        MAILBOX_PROCESSING_SECONDS.observe(time.monotonic() - started, outcome=outcome)
+        await session.close()
+        try:
+            await mailbox_leases.release([mailbox_id])
+        except Exception as e:
+            logger.error("Failed to release lease on mailbox %s: %s", mailbox_id, e)
+
+
+# Shared by the due-mailbox sweeper and manual "All Mailboxes" triggers
+mailbox_pool = MailboxWorkerPool(process_single_mailbox)
+
+Gauge(
+    "mailbox_pool_jobs",
+    "Mailboxes queued or being processed by this worker.",
+    ("state",),
+    callback=lambda: {
+        ("queued",): mailbox_pool.stats()["queued"],
+        ("in_flight",): mailbox_pool.stats()["in_flight"],
+    },
+)
+
+
+async def sweep_due_mailboxes(context):
+    # Single recurring job: finds mailboxes due before the next tick using the
+    # next_summary_time index and hands them to the worker pool. Each mailbox
+    # is first claimed through a lease row (database/leases.py), so when
+    # several processes sweep the same database every due mailbox goes to
+    # exactly one of them. A mailbox stays due until process_single_mailbox
+    # moves its next_summary_time and releases the lease.
+    horizon = datetime.utcnow() + timedelta(seconds=SCHEDULER_SWEEP_INTERVAL)
+    capacity = SCHEDULER_MAX_QUEUED - mailbox_pool.stats()["queued"]
+    if SCHEDULER_CLAIM_LIMIT > 0:
+        capacity = min(capacity, SCHEDULER_CLAIM_LIMIT)
+    dispatched = 0
+    last_key = None
+    models = set()
     session = get_session()
     try:
-        user = session.query(User).get(user_id)
-        if not user:
-            logger.error(f"User not found: {user_id}")
-            return
-
-        for mailbox in user.mailboxes:
-            await process_single_mailbox(context.bot, user.chat_id, mailbox.id)
-
-        # Reschedule the job
-        next_run = min((mb.next_summary_time for mb in user.mailboxes), default=None)
-        if next_run:
-            logger.info(f"Rescheduling summary job for user {user_id} at {next_run}")
-            context.job_queue.run_once(
-                process_user_mailboxes,
-                when=next_run,
-                data={"user_id": user_id},
-                name=f"user_{user_id}_summary",
+        while capacity > 0:
+            query = (
+                select(
+                    Mailbox.id, Mailbox.next_summary_time, Mailbox.model, User.chat_id
+                )
+                .join(User, Mailbox.user_id == User.id)
+                .where(Mailbox.next_summary_time <= horizon)
+            )
+            if last_key is not None:
+                # Keyset pagination over (next_summary_time, id)
+                query = query.where(
+                    tuple_(Mailbox.next_summary_time, Mailbox.id) > last_key
+                )
+            limit = min(SCHEDULER_SWEEP_BATCH, capacity)
+            result = await session.execute(
+                query.order_by(Mailbox.next_summary_time, Mailbox.id).limit(limit)
             )
+            rows = result.all()
+            claimed = await mailbox_leases.claim_many(session, [r.id for r in rows])
+            await session.commit()
+            if claimed:
+                # Another worker may have finished some of these between the
+                # select and the claim; hand those straight back
+                result = await session.scalars(
+                    select(Mailbox.id).where(
+                        Mailbox.id.in_(claimed), Mailbox.next_summary_time <= horizon
+                    )
+                )
+                due = set(result.all())
+                await session.commit()
+                if claimed - due:
+                    await mailbox_leases.release(list(claimed - due))
+                claimed = due
+            batch = [row for row in rows if row.id in claimed]
+            new_models = {ollama_client.model_for(row.model) for row in batch} - models
+            if OLLAMA_WARM_UP and new_models:
+                # Load the models while the workers are still fetching mail
+                models |= new_models
+                context.application.create_task(ollama_client.warm_up(new_models))
+            for mailbox_id, next_summary_time, model, chat_id in batch:
+                await mailbox_pool.submit(context.bot, chat_id, mailbox_id)
+            dispatched += len(batch)
+            capacity -= len(batch)
+            if len(rows) < limit:
+                break
+            last_key = (rows[-1].next_summary_time, rows[-1].id)
     except Exception as e:
-        logger.error(f"Error processing mailboxes for user {user_id}: {str(e)}")
+        logger.error("Error sweeping due mailboxes: %s", e)
     finally:
-        session.close()
+        await session.close()
+
+    if dispatched:
+        logger.info(
+            "Dispatched %s due mailboxes, pool: %s", dispatched, mailbox_pool.stats()
+        )
 
 
 async def send_summary(bot, chat_id, summary):
-    try:
-        await bot.send_message(
-            chat_id=chat_id,
-            text=format_for_telegram(summary),
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
-        logger.info(f"Summary sent to chat_id: {chat_id}")
-    except Exception as e:
-        logger.error(f"Error sending summary to chat_id {chat_id}: {str(e)}")
+    # Long summaries are split into several messages; see bot/delivery.py
+    delivered = await delivery_queue.send(
+        bot,
+        chat_id,
+        summary,
+        formatter=partial(format_for_telegram, parse_mode=TELEGRAM_PARSE_MODE),
+        parse_mode=TELEGRAM_PARSE_MODE,
+    )
+    if delivered:
+        logger.info("Summary sent to chat_id: %s", chat_id)
+    else:
+        logger.error("Error sending summary to chat_id %s", chat_id)
+    return delivered
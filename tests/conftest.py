@@ -0,0 +1,45 @@
+import asyncio
+import os
+import tempfile
+from contextlib import contextmanager
+
+# Must be set before anything imports config
+_db_dir = tempfile.mkdtemp(prefix="newsletter-bot-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+
+import pytest
+from sqlalchemy import event
+from database.migrations import migrate
+from database.models import async_engine
+
+
+@pytest.fixture(scope="session")
+def run():
+    # One event loop for the whole run: pooled aiosqlite connections belong
+    # to the loop that opened them
+    migrate()
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.run_until_complete(async_engine.dispose())
+    loop.close()
+
+
+@contextmanager
+def _count_statements():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+
+@pytest.fixture
+def count_statements():
+    # `with count_statements() as statements:` collects every SQL statement
+    # sent to the database inside the block
+    return _count_statements
@@ -0,0 +1,117 @@
+import random
+import time
+from api_clients.ollama import (
+    CHARS_PER_TOKEN,
+    _split_oversized,
+    chunk_text,
+    estimate_tokens,
+)
+
+WORDS = ["a", "news", "letter", "summary", "https://example.com/" + "x" * 60]
+
+
+def random_text(rng):
+    paragraphs = []
+    for _ in range(rng.randint(0, 8)):
+        sentences = []
+        for _ in range(rng.randint(1, 6)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(1, 30))]
+            if rng.random() < 0.1:
+                words.insert(rng.randrange(len(words) + 1), "Z" * rng.randint(1, 200))
+            sentences.append(" ".join(words) + rng.choice([".", "!", "?", ""]))
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def test_split_oversized_keeps_order():
+    text = "intro words " + "Z" * 25 + " tail"
+    assert _split_oversized(text, 4) == [
+        "intro words",
+        "Z" * 16,
+        "Z" * 9 + " tail",
+    ]
+
+
+def test_chunk_text_fuzz():
+    rng = random.Random(1234)
+    for _ in range(500):
+        text = random_text(rng)
+        max_tokens = rng.randint(2, 60)
+        chunks = chunk_text(text, max_tokens)
+        for chunk in chunks:
+            assert chunk.strip()
+            assert len(chunk) <= max_tokens * CHARS_PER_TOKEN
+            assert estimate_tokens(chunk) <= max_tokens
+        # Nothing lost, duplicated or reordered, except that over-long words
+        # are sliced
+        assert "".join("".join(chunks).split()) == "".join(text.split())
+
+
+def test_chunk_text_overlap_fuzz():
+    rng = random.Random(5678)
+    for _ in range(300):
+        text = random_text(rng)
+        max_tokens = rng.randint(4, 60)
+        chunks = chunk_text(text, max_tokens, overlap_tokens=max_tokens // 3)
+        for chunk in chunks:
+            assert len(chunk) <= max_tokens * CHARS_PER_TOKEN
+        if text.strip():
+            assert chunks[0].split()[0] in text.split()[0]
+            assert text.split()[-1].endswith(chunks[-1].split()[-1])
+
+
+def old_chunk_text(text, max_chunk_size=8000):
+    # Baseline: the chunker chunk_text replaced, with its default budget of
+    # 8000 chars (2000 tokens)
+    chunks = []
+    current_chunk = ""
+    for sentence in text.split("."):
+        if len(current_chunk) + len(sentence) < max_chunk_size:
+            current_chunk += sentence + "."
+        else:
+            chunks.append(current_chunk.strip())
+            current_chunk = sentence + "."
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks
+
+
+def newsletter(rng, size, paragraph_end="\n\n"):
+    words = ["alpha", "beta", "3.14", "https://ex.ample.com/a.b?c=d", "e.g.", "data"]
+    sentences = []
+    total = 0
+    while total < size:
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(3, 40)))
+        sentence += rng.choice([". ", "! ", "? ", "." + paragraph_end])
+        if rng.random() < 0.001:
+            sentence = "y" * 40_000 + ". "
+        sentences.append(sentence)
+        total += len(sentence)
+    return "".join(sentences)
+
+
+def _best_of(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def test_chunk_time_against_old_chunker():
+    # Microbenchmark on multi-megabyte newsletters. The old chunker was fast
+    # only because CPython optimises in-place str +=, and it emitted chunks
+    # up to 5x over budget. The new one stays within budget, linear, and
+    # within a small factor of the old one; bounds are loose on purpose.
+    rng = random.Random(7)
+    for paragraph_end in ("\n\n", " "):
+        small = newsletter(rng, 1_000_000, paragraph_end)
+        large = newsletter(rng, 4_000_000, paragraph_end)
+        assert max(map(len, old_chunk_text(large))) > 8000
+        assert max(map(len, chunk_text(large, 2000))) <= 8000
+
+        new_small = _best_of(chunk_text, small, 2000)
+        new_large = _best_of(chunk_text, large, 2000)
+        assert new_large < 10 * max(new_small, 0.005)
+        assert new_large < 8 * max(_best_of(old_chunk_text, large), 0.01)
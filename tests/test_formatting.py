@@ -0,0 +1,200 @@
+import random
+import re
+import time
+from functools import partial
+from html.parser import HTMLParser
+from telegram.constants import ParseMode
+from bot.delivery import split_message
+from formatting import format_for_telegram
+
+RESERVED = set("_*[]()~`>#+-=|{}.!")
+
+FUZZ_ALPHABET = [
+    "*",
+    "**",
+    "_",
+    "__",
+    "`",
+    "[",
+    "]",
+    "(",
+    ")",
+    "](",
+    " ",
+    " ",
+    "\n",
+    "\n\n",
+    "word",
+    "snake_case",
+    "a.b.c",
+    "http://x.com/a.b?c=d",
+    "- ",
+    "# ",
+    "1. ",
+    "!",
+    "\\",
+    "<",
+    "&",
+    ">",
+    "~",
+    "|",
+]
+
+
+def validate_markdown_v2(text):
+    # Minimal model of Telegram's MarkdownV2 parser: every reserved character
+    # is escaped or part of a closed, properly nested bold / italic / code /
+    # link entity, and no entity is nested in one of the same kind.
+    stack = []
+    i = 0
+    n = len(text)
+    while i < n:
+        char = text[i]
+        if char == "\\":
+            assert i + 1 < n and text[i + 1] in RESERVED | {"\\"}, text[i : i + 5]
+            i += 2
+            continue
+        if char == "`":
+            assert not stack, "code inside another entity"
+            j = i + 1
+            while True:
+                assert j < n, "unclosed code"
+                if text[j] == "\\":
+                    j += 2
+                    continue
+                if text[j] == "`":
+                    break
+                j += 1
+            i = j + 1
+            continue
+        if text.startswith("__", i):
+            raise AssertionError(f"underline marker in {text[i - 10 : i + 10]!r}")
+        if char in "*_":
+            if stack and stack[-1] == char:
+                stack.pop()
+            else:
+                assert char not in stack, "entity nested in its own kind"
+                stack.append(char)
+            i += 1
+            continue
+        if char == "[":
+            assert "[" not in stack, "link inside a link"
+            stack.append("[")
+            i += 1
+            continue
+        if char == "]":
+            assert stack and stack[-1] == "[", "] without ["
+            stack.pop()
+            assert text[i + 1 : i + 2] == "(", "link without url"
+            j = i + 2
+            while text[j] != ")":
+                if text[j] == "\\":
+                    j += 1
+                j += 1
+            i = j + 1
+            continue
+        assert char not in RESERVED, f"unescaped {char!r} in {text[i - 10 : i + 10]!r}"
+        i += 1
+    assert not stack, f"unclosed {stack}"
+
+
+class _HTMLValidator(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        assert tag in ("b", "i", "a", "code"), tag
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        assert self.stack and self.stack.pop() == tag, tag
+
+
+def validate_html(text):
+    validator = _HTMLValidator()
+    validator.feed(text)
+    validator.close()
+    assert not validator.stack, f"unclosed {validator.stack}"
+
+
+def words(text):
+    return "".join(re.findall(r"[A-Za-z0-9]+", text))
+
+
+def random_markdown(rng, max_tokens=40):
+    return "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, max_tokens)))
+
+
+def test_entities_and_links():
+    text = "**Bold** and _it_ and [site](https://a.b.example.com/x.y)"
+    assert format_for_telegram(text) == (
+        "*Bold* and _it_ and [site](https://a.b.example.com/x.y)"
+    )
+    assert format_for_telegram(text, ParseMode.HTML) == (
+        '<b>Bold</b> and <i>it</i> and <a href="https://a.b.example.com/x.y">site</a>'
+    )
+
+
+def test_lists_headings_and_wrapped_lines():
+    text = "# Heading\n- one\n- **two**\nwrapped\nline"
+    assert format_for_telegram(text) == "*Heading*\n• one\n• *two*\nwrapped line"
+
+
+def test_code_and_literal_underscores():
+    text = "use `code_here()` and snake_case"
+    assert format_for_telegram(text) == "use `code_here()` and snake\\_case"
+
+
+def test_format_fuzz():
+    # Marker-heavy random input always gives output Telegram accepts, and
+    # only markup is ever dropped, never words
+    rng = random.Random(17)
+    for _ in range(5000):
+        text = random_markdown(rng)
+        formatted = format_for_telegram(text)
+        validate_markdown_v2(formatted)
+        validate_html(format_for_telegram(text, ParseMode.HTML))
+        assert words(formatted) == words(text), (text, formatted)
+
+
+def test_split_message_fuzz():
+    # Every part of a long summary is a complete, valid message of its own
+    rng = random.Random(23)
+    formatter = partial(format_for_telegram, parse_mode=ParseMode.MARKDOWN_V2)
+    for _ in range(20):
+        text = "\n\n".join(random_markdown(rng, 400) for _ in range(rng.randint(1, 60)))
+        for formatted, raw in split_message(text, formatter, limit=1000):
+            assert len(formatted) <= 1000
+            validate_markdown_v2(formatted)
+            assert formatted == formatter(raw)
+
+
+def _best_of(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def test_format_time_is_linear():
+    # Microbenchmark. The previous formatter took ~6.5 s on 40k characters of
+    # unmatched "[" and was quadratic in them; bounds are loose on purpose
+    # so a slow CI machine doesn't fail, while quadratic behaviour would.
+    paragraph = (
+        "**Headline** with _emphasis_ and a [link](https://news.example.com/a/b.html)."
+        " Some 1+1=2 text! (yes)\n"
+    )
+    small = paragraph * 100
+    large = paragraph * 1600
+    assert _best_of(format_for_telegram, large) < 40 * _best_of(
+        format_for_telegram, small
+    )
+
+    unmatched = "[a" * 20_000 + "]("
+    assert _best_of(format_for_telegram, unmatched, repeat=1) < 1.0
+    assert _best_of(format_for_telegram, "[a" * 80_000 + "](", repeat=1) < 20 * max(
+        _best_of(format_for_telegram, unmatched), 0.005
+    )
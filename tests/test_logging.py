@@ -0,0 +1,97 @@
+import contextlib
+import io
+import logging
+import time
+import pytest
+from logging_setup import SAMPLED, configure_logging
+
+# Benchmark of the logging done per processed mailbox: the statements the
+# bot used to run for every message against the ones it runs now.
+
+HTML = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 2500
+MESSAGES = [
+    {"id": f"m{i}", "subject": f"Issue {i}", "text": "", "html": [HTML]}
+    for i in range(50)
+]
+STATS = {"input_bytes": 140_000, "output_bytes": 139_000}
+
+logger = logging.getLogger("tasks")
+
+
+def old_mailbox():
+    # Baseline: a print of the whole payload in mail_tm.fetch_message and
+    # eagerly formatted f-strings in tasks and mail_tm
+    for message in MESSAGES:
+        print(f"Full unread message data: {message}")
+        logger.debug(f"Processing unread message: {message}")
+        logger.debug(
+            f"Cleaned message {message.get('id')}: "
+            f"{STATS['input_bytes']} -> {STATS['output_bytes']} bytes"
+        )
+        logger.info(f"Marked message {message['id']} as read")
+
+
+def new_mailbox():
+    for message in MESSAGES:
+        logger.debug("Fetched message %s", message["id"], extra=SAMPLED)
+        logger.debug(
+            "Processing unread message %s (%r, %s chars)",
+            message["id"],
+            message["subject"],
+            len(HTML),
+            extra=SAMPLED,
+        )
+        logger.debug(
+            "Cleaned message %s: %s -> %s bytes",
+            message["id"],
+            STATS["input_bytes"],
+            STATS["output_bytes"],
+            extra=SAMPLED,
+        )
+        logger.debug("Marked message %s as read", message["id"], extra=SAMPLED)
+
+
+@pytest.fixture
+def restore_logging():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def _mailbox_cost(func, level, fmt="text", repeat=5):
+    # Best CPU time and bytes written for one mailbox
+    out = io.StringIO()
+    if func is old_mailbox:
+        logging.basicConfig(
+            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            level=level,
+            handlers=[logging.StreamHandler(out)],
+            force=True,
+        )
+    else:
+        configure_logging(level, fmt, stream=out)
+    best = float("inf")
+    with contextlib.redirect_stdout(out):
+        for _ in range(repeat):
+            started = time.process_time()
+            func()
+            best = min(best, time.process_time() - started)
+    return best, len(out.getvalue()) / repeat
+
+
+def test_logging_overhead_per_mailbox(restore_logging):
+    # Microbenchmark. Before, a mailbox of 50 ~140 KB newsletters cost ~40 ms
+    # of CPU and wrote ~7 MB even at INFO; now nothing is formatted at INFO
+    # and DEBUG writes a sampled line or two. Bounds are loose on purpose.
+    old_seconds, old_bytes = _mailbox_cost(old_mailbox, "INFO")
+    info_seconds, info_bytes = _mailbox_cost(new_mailbox, "INFO")
+    debug_seconds, debug_bytes = _mailbox_cost(new_mailbox, "DEBUG")
+    json_seconds, json_bytes = _mailbox_cost(new_mailbox, "DEBUG", "json")
+
+    assert old_bytes > 5_000_000
+    assert info_bytes == 0
+    assert debug_bytes < 5_000 and json_bytes < 5_000
+    assert info_seconds < old_seconds / 20
+    assert max(debug_seconds, json_seconds) < old_seconds / 3
@@ -0,0 +1,40 @@
+from api_clients.llm_backends import OllamaBackend
+from api_clients.token_cache import token_cache
+from bot.delivery import delivery_queue
+from metrics import REGISTRY, Counter, Registry
+
+
+def test_callback_counter_reads_its_source_at_scrape_time():
+    registry = Registry()
+    stats = {"hit": 1, "miss": 0}
+    Counter(
+        "lookups_total",
+        "Lookups.",
+        ("result",),
+        registry=registry,
+        callback=lambda: {(key,): value for key, value in stats.items()},
+    )
+    stats["miss"] = 3
+    text = registry.render()
+    assert "# TYPE lookups_total counter" in text
+    assert 'lookups_total{result="hit"} 1' in text
+    assert 'lookups_total{result="miss"} 3' in text
+
+
+def test_shutdown_stats_are_exported():
+    token_cache.refreshes += 2
+    delivery_queue.retries += 1
+    OllamaBackend("http://warm-up.test").record_warm_up(1.5, cold=True)
+    text = REGISTRY.render()
+    for line in (
+        'mail_tm_connections{state="idle"} 0',
+        'mail_tm_connections{state="in_flight"} 0',
+        f'mail_tm_token_cache_total{{result="refresh"}} {token_cache.refreshes}',
+        "mail_tm_token_cache_size ",
+        "summary_cache_saved_seconds_total ",
+        'telegram_delivery_total{result="retried"} 1',
+        "telegram_delivery_waiting_retry 0",
+        'llm_warm_up_seconds_count{backend="http://warm-up.test",kind="cold"} 1',
+    ):
+        assert line in text, line
+    assert "Failed to collect" not in text
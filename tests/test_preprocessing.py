@@ -0,0 +1,30 @@
+from preprocessing import extract_message_text, unwrap_url
+
+
+def test_html_entities_are_decoded_once():
+    # "&amp;lt;div&amp;gt;" in HTML is the literal text "&lt;div&gt;"
+    message = {"html": ["<p>Use &amp;lt;div&amp;gt; &amp; friends</p>"]}
+    text, _ = extract_message_text(message)
+    assert text == "Use &lt;div&gt; & friends"
+
+
+def test_plain_text_entities_are_decoded():
+    text, _ = extract_message_text({"text": "Fish &amp; chips"})
+    assert text == "Fish & chips"
+
+
+def test_unwrap_url_keeps_untouched_queries():
+    assert unwrap_url("https://a.example.com/?flag&x=1") == (
+        "https://a.example.com/?flag&x=1"
+    )
+    assert unwrap_url("https://a.example.com/?q=a%20b") == (
+        "https://a.example.com/?q=a%20b"
+    )
+
+
+def test_unwrap_url_drops_tracking_params():
+    assert unwrap_url("https://a.example.com/?x=1&utm_source=mail") == (
+        "https://a.example.com/?x=1"
+    )
+    wrapped = "https://click.example.com/?url=https%3A%2F%2Fb.example.com%2F%3Fid%3D7"
+    assert unwrap_url(wrapped) == "https://b.example.com/?id=7"
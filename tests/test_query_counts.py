@@ -0,0 +1,166 @@
+import itertools
+from types import SimpleNamespace
+import pytest
+from telegram.ext import ConversationHandler
+from bot import commands
+from database.models import get_session, User, Mailbox
+import tasks
+from config import LLM_MODEL
+
+# Every handler loads what it needs in a fixed number of statements, however
+# many mailboxes the user has (no N+1, no lazy loads)
+
+_chat_ids = itertools.count(1000)
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.edits = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent))
+
+
+def make_update(chat_id, data=None):
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        message=FakeMessage(),
+        callback_query=FakeQuery(data),
+    )
+
+
+def make_context(*args, **user_data):
+    return SimpleNamespace(args=list(args), bot=FakeBot(), user_data=user_data)
+
+
+@pytest.fixture
+def user(run):
+    # A user with three mailboxes; returns (chat_id, [mailbox ids])
+    chat_id = next(_chat_ids)
+
+    async def create():
+        session = get_session()
+        try:
+            mailboxes = [
+                Mailbox(email=f"{chat_id}-{i}@example.com", password="pw", tag=f"t{i}")
+                for i in range(3)
+            ]
+            session.add(User(chat_id=str(chat_id), mailboxes=mailboxes))
+            await session.commit()
+            return chat_id, [mailbox.id for mailbox in mailboxes]
+        finally:
+            await session.close()
+
+    return run(create())
+
+
+def test_list_mailboxes(run, user, count_statements):
+    chat_id, _ = user
+    update = make_update(chat_id)
+    with count_statements() as statements:
+        run(commands.list_mailboxes(update, make_context()))
+    assert update.message.replies[0].startswith("Your mailboxes:")
+    assert len(statements) == 1
+
+
+def test_set_model(run, user, count_statements):
+    chat_id, _ = user
+    update = make_update(chat_id)
+    with count_statements() as statements:
+        run(commands.set_model(update, make_context("t1", LLM_MODEL)))
+    assert update.message.replies[0].startswith("Summaries for t1")
+    # load + update
+    assert len(statements) == 2
+
+
+def test_set_frequency(run, user, count_statements):
+    chat_id, mailbox_ids = user
+    update = make_update(chat_id)
+    with count_statements() as statements:
+        state = run(commands.set_frequency(update, make_context()))
+    assert state == commands.SELECTING_MAILBOX
+    assert len(statements) == 1
+
+    update = make_update(chat_id, "freq:weekly")
+    context = make_context(selected_mailbox=str(mailbox_ids[0]))
+    with count_statements() as statements:
+        state = run(commands.frequency_selected(update, context))
+    assert state == ConversationHandler.END
+    assert "set to weekly" in update.callback_query.edits[0]
+    # load + update
+    assert len(statements) == 2
+
+
+def test_trigger_summary_lists_mailboxes(run, user, count_statements):
+    chat_id, _ = user
+    update = make_update(chat_id)
+    with count_statements() as statements:
+        state = run(commands.trigger_summary(update, make_context()))
+    assert state == commands.SELECTING_MAILBOX_FOR_SUMMARY
+    assert len(statements) == 1
+
+
+def test_create_mailbox(run, count_statements, monkeypatch):
+    async def get_domains():
+        return [{"domain": "example.com"}]
+
+    async def create_account(email, password):
+        return {"id": "account"}
+
+    async def get_token(email, password):
+        return "token"
+
+    monkeypatch.setattr(commands.mail_tm_client, "get_domains", get_domains)
+    monkeypatch.setattr(commands.mail_tm_client, "create_account", create_account)
+    monkeypatch.setattr(commands.mail_tm_client, "get_token", get_token)
+    chat_id = next(_chat_ids)
+    update = make_update(chat_id)
+    with count_statements() as statements:
+        run(commands.create_mailbox(update, make_context("news")))
+    assert update.message.replies[0].startswith("Mailbox created")
+    # load user, insert user, insert mailbox
+    assert len(statements) == 3
+
+    update = make_update(chat_id)
+    with count_statements() as statements:
+        run(commands.create_mailbox(update, make_context("more")))
+    assert update.message.replies[0].startswith("Mailbox created")
+    # load user, insert mailbox
+    assert len(statements) == 2
+
+
+def test_process_single_mailbox(run, user, count_statements, monkeypatch):
+    chat_id, mailbox_ids = user
+
+    async def fetch_emails_for_mailbox(mailbox):
+        return []
+
+    monkeypatch.setattr(tasks, "fetch_emails_for_mailbox", fetch_emails_for_mailbox)
+    bot = FakeBot()
+    with count_statements() as statements:
+        run(tasks.process_single_mailbox(bot, chat_id, mailbox_ids[0]))
+    assert bot.sent[-1].startswith("No new unread emails")
+    # claim lease (insert + update), load mailbox, load undigested emails,
+    # move next_summary_time, release lease
+    assert len(statements) == 6
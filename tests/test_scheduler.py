@@ -0,0 +1,81 @@
+import asyncio
+from types import SimpleNamespace
+from telegram.ext import ConversationHandler
+from bot import commands
+from scheduler import MailboxWorkerPool
+
+
+def test_urgent_jobs_skip_the_queue():
+    async def scenario():
+        order = []
+        release = asyncio.Event()
+
+        async def handler(bot, chat_id, mailbox_id):
+            if mailbox_id == 0:
+                await release.wait()
+            order.append(mailbox_id)
+
+        pool = MailboxWorkerPool(handler, workers=1, per_user_concurrency=1)
+        # Mailbox 0 keeps the only worker busy while the rest queue up
+        await pool.submit(None, "busy", 0)
+        await asyncio.sleep(0)
+        for mailbox_id in range(1, 6):
+            await pool.submit(None, f"user{mailbox_id}", mailbox_id)
+        manual = await pool.submit(None, "manual", 99, urgent=True)
+        # Joining a queued job urgently moves it forward too
+        joined = await pool.submit(None, "user5", 5, urgent=True)
+        release.set()
+        await asyncio.wait_for(asyncio.gather(manual, joined), 1)
+        await pool.stop()
+        return order
+
+    order = asyncio.run(scenario())
+    assert order[:3] == [0, 5, 99]
+
+
+def test_manual_trigger_does_not_wait_for_processing(monkeypatch):
+    async def scenario():
+        started = asyncio.Event()
+        release = asyncio.Event()
+        sent = []
+        tasks = []
+
+        async def handler(bot, chat_id, mailbox_id):
+            started.set()
+            await release.wait()
+
+        async def send_message(chat_id, text, **kwargs):
+            sent.append(text)
+
+        async def answer():
+            pass
+
+        async def edit_message_text(text, **kwargs):
+            pass
+
+        pool = MailboxWorkerPool(handler, workers=1)
+        monkeypatch.setattr(commands, "mailbox_pool", pool)
+        update = SimpleNamespace(
+            effective_chat=SimpleNamespace(id=1),
+            callback_query=SimpleNamespace(
+                data="summary:7", answer=answer, edit_message_text=edit_message_text
+            ),
+        )
+        context = SimpleNamespace(
+            bot=SimpleNamespace(send_message=send_message),
+            application=SimpleNamespace(
+                create_task=lambda coro: tasks.append(asyncio.create_task(coro))
+            ),
+        )
+        state = await asyncio.wait_for(
+            commands.mailbox_selected_for_summary(update, context), 1
+        )
+        assert state == ConversationHandler.END
+        await asyncio.wait_for(started.wait(), 1)
+        assert sent == []
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        await pool.stop()
+        return sent
+
+    assert asyncio.run(scenario()) == ["Mailbox has been processed."]
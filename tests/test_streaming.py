@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+from aiohttp import web
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter
+from api_clients.llm_backends import BackendPool, OllamaBackend
+from api_clients.ollama import OllamaClient
+from bot.progress import FALLBACK_NOTE, ProgressiveMessage
+
+# End-to-end: a local server speaking Ollama's NDJSON streaming API feeds
+# OllamaClient, whose partial output is pushed into a ProgressiveMessage on
+# a fake bot.
+
+PIECES = [f"word{i} " for i in range(40)]
+PIECE_DELAY = 0.01
+
+
+async def generate_handler(request):
+    payload = await request.json()
+    if not payload["stream"]:
+        return web.json_response({"response": "".join(PIECES), "done": True})
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    for piece in PIECES:
+        await response.write(json.dumps({"response": piece}).encode() + b"\n")
+        await asyncio.sleep(PIECE_DELAY)
+    await response.write(
+        json.dumps(
+            {"response": "", "done": True, "prompt_eval_count": 10, "eval_count": 40}
+        ).encode()
+        + b"\n"
+    )
+    await response.write_eof()
+    return response
+
+
+class FakeBot:
+    # Records edits; `retry_after` makes the first edit hit flood control
+    def __init__(self, retry_after=None):
+        self.edits = []
+        self.retry_after = retry_after
+
+    async def edit_message_text(self, chat_id, message_id, text, parse_mode=None):
+        if self.retry_after is not None:
+            retry_after, self.retry_after = self.retry_after, None
+            raise RetryAfter(retry_after)
+        self.edits.append((time.monotonic(), text))
+
+
+async def stream_summary(bot, min_interval, final=None):
+    app = web.Application()
+    app.router.add_post("/api/generate", generate_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    client = OllamaClient(
+        BackendPool(
+            [OllamaBackend(f"http://127.0.0.1:{port}")], health_check_interval=0
+        )
+    )
+    client.stream = True
+    try:
+        progress = ProgressiveMessage(bot, 1, 1, min_interval=min_interval)
+        summary = await client.summarize_text("Some newsletter.", progress.update)
+        finished = await progress.finish(final or summary)
+        return summary, finished, progress
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+def test_stream_is_throttled_and_finished():
+    bot = FakeBot()
+    summary, finished, progress = asyncio.run(stream_summary(bot, min_interval=0.05))
+    assert summary == "".join(PIECES)
+    assert finished
+    texts = [text for _, text in bot.edits]
+    # Drafts grow and are marked as unfinished; the last edit is the summary
+    assert texts[-1] == summary
+    assert texts[:-1] and all(text.endswith(" …") for text in texts[:-1])
+    assert all(len(a) < len(b) for a, b in zip(texts[:-2], texts[1:-1]))
+    # Throttled: far fewer edits than streamed pieces, spaced by the interval
+    assert len(texts) < len(PIECES) / 2
+    times = [at for at, _ in bot.edits[:-1]]
+    assert all(b - a >= 0.05 for a, b in zip(times, times[1:]))
+
+
+def test_flood_control_pauses_edits():
+    bot = FakeBot(retry_after=0.2)
+    started = time.monotonic()
+    summary, finished, progress = asyncio.run(stream_summary(bot, min_interval=0))
+    assert finished
+    # Nothing was sent while blocked, and the final edit waited it out
+    assert bot.edits[0][0] - started >= 0.2
+    assert bot.edits[-1][1] == summary
+
+
+def test_finish_falls_back_to_a_note():
+    bot = FakeBot()
+    too_long = "x" * (MessageLimit.MAX_TEXT_LENGTH + 1)
+    summary, finished, progress = asyncio.run(
+        stream_summary(bot, min_interval=0.05, final=too_long)
+    )
+    assert not finished
+    # The truncated draft is replaced; the caller sends the summary itself
+    assert bot.edits[-1][1] == FALLBACK_NOTE